@@ -5,28 +5,592 @@ import yaml
 import subprocess
 from subprocess import *
 import os
+import re
 import sys
+import ast
 import time
+import json
+import signal
+import queue
+import asyncio
+import collections
+import shutil
+import tempfile
+import fcntl
+import socket
+import threading
+import functools
+import xmlrpc.client
+import http.client
+import http.server
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+import glob
+import difflib
+import hashlib
+import sysconfig
+import importlib.util
+import importlib.metadata
 import pexpect
 import xml.etree.ElementTree as ET
+try:
+    from packaging.requirements import Requirement, InvalidRequirement
+except ImportError:
+    # packaging が無い場合はバージョン指定の無い要求・== 指定のみ判定する
+    Requirement = None
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 BASH = '/bin/bash'
 home_path = os.environ['HOME']
 ros_ws = os.environ['ROS_WS']
 rtm_ws = os.environ['RTM_WS']
 
+# キャッシュ(依存関係の照会結果など)の保存先
+cache_dir = os.environ.get('RTSI_CACHE_DIR', os.path.join(home_path, '.cache', 'rtsi_fw'))
+
+# 同時に実行するフェッチ(clone)の数の既定値（--jobs で変更）
+FETCH_WORKERS = 4
+
+# gitリポジトリのミラー(bareリポジトリ)の保存先．ワークスペースへはここから clone する
+git_mirror_dir = os.environ.get('RTSI_GIT_MIRROR', os.path.join(cache_dir, 'git'))
+
+# ビルド成果物を共有するディレクトリ（NFSなども可．--artifact-cache で変更，未指定の場合は使わない）
+artifact_cache_dir = os.environ.get('RTSI_ARTIFACT_CACHE')
+
+# ヘッドレス起動時の再起動間隔[s]（異常終了が続くと倍々に伸ばす）
+RESTART_BACKOFF = 1.0
+RESTART_BACKOFF_MAX = 60.0
+# この時間[s]以上動作してから終了した場合は再起動間隔を初期値に戻す
+RESTART_RESET = 30.0
+
+# ヘッドレス起動時のログファイルをローテーションするサイズ[byte]と残す世代数
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+# コンポーネントごとにメモリに残す出力の行数と，異常終了時に表示する行数
+LOG_BUFFER_LINES = 1000
+LOG_CRASH_LINES = 5
+# パイプから1回に読み込む最大の長さ[byte]．1行がこれを超える場合は分割する
+LOG_READ_SIZE = 64 * 1024
+# ファイルへの書き込みを待つ読み込み単位の数の上限（超えた分は破棄し，コンポーネントを待たせない）
+LOG_QUEUE_CHUNKS = 1024
+
+# 起動したコンポーネントの準備完了を待つ時間[s]の既定値
+READY_TIMEOUT = 60.0
+
+# run --lazy: サービスアプリケーションが実行中のタスク番号(0から)を設定するROSパラメータ
+SCENARIO_STEP_PARAM = '/rtsi/scenario_step'
+# 実行中のタスクから何タスク先までのHRI機能を起動しておくか（--lookahead で変更）
+LAZY_LOOKAHEAD = 1
+# このパラメータが設定されないまま経過したら残りのHRI機能を全て起動する時間[s]（--step-timeout で変更）
+LAZY_STEP_TIMEOUT = 30.0
+
+# コンポーネントのリソース使用量を計測する間隔[s]（--metrics-interval で変更）
+METRICS_INTERVAL = 5.0
+# omniNames(ネームサーバ)のポート
+NAMESERVER_PORT = int(os.environ.get('RTSI_NAMESERVER_PORT', 2809))
+
+# PyPI/aptの照会結果をキャッシュする期間[s]
+LOOKUP_CACHE_TTL = 7 * 24 * 60 * 60
+
+# 値を伴うコマンドラインオプション
+VALUE_OPTIONS = ['--jobs', '--index-dir', '--trace', '--git-depth', '--git-filter', '--bundle-dir', '--fleet', '--lookahead', '--step-param',
+                 '--step-timeout', '--metrics', '--metrics-port', '--metrics-interval', '--lines', '--artifact-cache']
+
+
+############################## コマンドラインオプションの解析 ##############################
+def parse_options(argv):
+    """ 位置引数と --xxx 形式のオプションを分離する """
+    positional = []
+    options = {}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith('--'):
+            key, sep, value = arg.partition('=')
+            if not sep:
+                if key in VALUE_OPTIONS and i + 1 < len(argv):
+                    i += 1
+                    value = argv[i]
+                else:
+                    value = True
+            options[key[2:].replace('-', '_')] = value
+        else:
+            positional.append(arg)
+        i += 1
+    return positional, options
+
+############################## ロボットごとの出力先(フリート) ##############################
+# 現在のスレッドが出力しているロボットのログ（robot_output() の中でのみ設定される）
+robot_output_state = threading.local()
+
+
+class RobotOutput:
+    """ print の出力先をスレッドごとに切り替える標準出力（ロボットのログが無いスレッドは元の出力先） """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        return (robot_log() or self.stream).write(text)
+
+    def flush(self):
+        (robot_log() or self.stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def robot_log():
+    """ 現在のスレッドの出力先のログファイル（無ければNone） """
+    return getattr(robot_output_state, 'log', None)
+
+
+@contextmanager
+def robot_output(log_path):
+    """ このスレッドの print とコマンドの出力を log_path に保存する """
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    if not isinstance(sys.stdout, RobotOutput):
+        sys.stdout = RobotOutput(sys.stdout)
+    with open(log_path, 'a', encoding='utf-8', buffering=1) as log:
+        robot_output_state.log = log
+        try:
+            yield log
+        finally:
+            robot_output_state.log = None
+
+
+############################## 処理時間の計測(トレース) ##############################
+# 計測したspan（Chromeのtrace event形式）
+trace_events = []
+trace_lock = threading.Lock()
+trace_origin = time.perf_counter()
+
+
+def trace_record(name, cat, start, end, **trace_args):
+    """ 開始・終了時刻(perf_counter)からspanを記録する """
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_native_id(),
+             'ts': (start - trace_origin) * 1e6, 'dur': (end - start) * 1e6, 'args': trace_args}
+    with trace_lock:
+        trace_events.append(event)
+
+
+def trace_instant(name, cat='launch', **trace_args):
+    """ 時間幅の無いイベント（コンポーネントの起動など）を記録する """
+    event = {'name': name, 'cat': cat, 'ph': 'i', 's': 't', 'pid': os.getpid(), 'tid': threading.get_native_id(),
+             'ts': (time.perf_counter() - trace_origin) * 1e6, 'args': trace_args}
+    with trace_lock:
+        trace_events.append(event)
+
+
+@contextmanager
+def trace_span(name, cat='phase', **trace_args):
+    """ withブロックの処理時間を記録する """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace_record(name, cat, start, time.perf_counter(), **trace_args)
+
+
+def traced(function):
+    """ 関数の処理時間を記録するデコレータ """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with trace_span(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def run_command(command, **kwargs):
+    """
+    subprocess.run と同じ．実行時間をトレースに記録する．
+    フリートモードでロボットのログに出力している場合は，コマンドの出力もそのログに保存する．
+    """
+    log = robot_log()
+    if log is not None and 'stdout' not in kwargs and not kwargs.get('capture_output'):
+        log.flush()
+        kwargs['stdout'] = log
+        kwargs.setdefault('stderr', subprocess.STDOUT)
+    label = command if isinstance(command, str) else ' '.join(str(arg) for arg in command)
+    with trace_span(label, 'subprocess', cwd=str(kwargs.get('cwd') or os.getcwd())):
+        return subprocess.run(command, **kwargs)
+
+
+def call_command(command, **kwargs):
+    """ subprocess.call と同じ．実行時間をトレースに記録する """
+    return run_command(command, **kwargs).returncode
+
+
+def write_trace(trace_path):
+    """ 記録したspanをChromeのtrace event形式(chrome://tracing, Perfetto)で書き出す """
+    with trace_lock:
+        events = list(trace_events)
+    with open(trace_path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+    print(f"トレースを書き出しました: {trace_path} ({len(events)} events)")
+
+
+def print_trace_summary(top=15):
+    """ 時間のかかった処理の上位を表示する """
+    with trace_lock:
+        spans = sorted((event for event in trace_events if event['ph'] == 'X'), key=lambda event: -event['dur'])
+    if not spans:
+        return
+    print("------------------------- 処理時間 (上位) -------------------------")
+    print(f"{'time[s]':>9}  {'category':10}  name")
+    for event in spans[:top]:
+        print(f"{event['dur'] / 1e6:9.2f}  {event['cat']:10}  {event['name'][:100]}")
+
 
 ############################## YAML形式のシナリオファイルの読み込み ##############################
+# libyamlがあればCの実装で読み込む
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
 def load_yaml(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
-        return yaml.safe_load(file)
+        return yaml.load(file, Loader=YamlLoader)
+
+
+############################## 設定ファイル(ロボット・シナリオ)のモデル ##############################
+class ConfigError(ValueError):
+    """ ロボットファイル・シナリオファイルの記述の誤り """
+
+
+@dataclass
+class GitRepository:
+    url: str
+    repo: str
+    branch: object = None
+
+
+@dataclass
+class CollectConfig:
+    engine: list = field(default_factory=list)
+    rtm: list = field(default_factory=list)
+    apt: list = field(default_factory=list)
+    aptros: list = field(default_factory=list)
+    pip: list = field(default_factory=list)
+    git: list = field(default_factory=list)
+    other: list = field(default_factory=list)
+
+
+@dataclass
+class RunConfig:
+    roslaunch: list = field(default_factory=list)
+    rosrun: list = field(default_factory=list)
+    rtm: list = field(default_factory=list)
+    # ファイルに記載されていたキー（"No RTM module" などの表示用）
+    keys: list = field(default_factory=list)
+
+
+@dataclass
+class RobotConfig:
+    path: str
+    collect: CollectConfig
+    run: RunConfig
+    param: dict
+
+    @property
+    def engine(self):
+        """ 扱うサービスパッケージ(HRI engine)．無い場合は "None" """
+        return self.collect.engine[0] if self.collect.engine else "None"
+
+
+@dataclass
+class ScenarioTask:
+    task: str
+    act: object = None
+    arg: object = None
+
+
+@dataclass
+class Scenario:
+    path: str
+    tasks: list
+
+    @property
+    def functions(self):
+        """ シナリオで使うHRI機能（重複なし，初出順） """
+        functions = []
+        for task in self.tasks:
+            if task.task not in functions:
+                functions.append(task.task)
+        return functions
+
+
+COLLECT_LIST_KEYS = ['engine', 'rtm', 'apt', 'aptros', 'pip', 'other']
+RUN_KEYS = ['roslaunch', 'rosrun', 'rtm']
+RUN_ENTRY_KEYS = ['cmd', 'name', 'after', 'ready', 'timeout']
+# ready に書ける準備完了の判定（probe_ready を参照）
+READY_KINDS = ['port', 'topic', 'service', 'param', 'node', 'rtc']
+
+
+def parse_name_list(value, where, errors):
+    """
+    パッケージ名のリストを検証する．
+    [null] は「項目なし」として空のリストにし，nullと名前が混在している場合はエラーにする．
+    """
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        errors.append(f"{where}: リストで記述してください")
+        return []
+
+    items = [item for item in value if item is not None]
+    if items and len(items) != len(value):
+        errors.append(f"{where}: null と項目が混在しています {value}")
+    for index, item in enumerate(value):
+        if item is not None and not isinstance(item, str):
+            errors.append(f"{where}[{index}]: 文字列で記述してください ({item!r})")
+    return [str(item) for item in items]
+
+
+def parse_git_list(value, where, errors):
+    """ gitリポジトリのリストを検証する（url, repo, branch が全てnullの項目は「項目なし」） """
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        errors.append(f"{where}: リストで記述してください")
+        return []
+
+    repositories = []
+    for index, item in enumerate(value):
+        if item is None or (isinstance(item, dict) and not any(item.values())):
+            continue
+        if not isinstance(item, dict):
+            errors.append(f"{where}[{index}]: url, repo, branch を持つ項目で記述してください")
+            continue
+        url = item.get('url')
+        if not isinstance(url, str) or not url:
+            errors.append(f"{where}[{index}].url: リポジトリのURLがありません")
+            continue
+        repo = item.get('repo') or os.path.basename(url.rstrip('/')).replace('.git', '')
+        branch = item.get('branch')
+        repositories.append(GitRepository(url, str(repo), None if branch is None else str(branch)))
+    return repositories
+
+
+def parse_collect_section(data, where, errors):
+    """ collectセクションを検証して CollectConfig を作る """
+    if data is None:
+        return CollectConfig()
+    if not isinstance(data, dict):
+        errors.append(f"{where}: 辞書で記述してください")
+        return CollectConfig()
+
+    collect_config = CollectConfig(**{key: parse_name_list(data.get(key), f"{where}.{key}", errors)
+                                      for key in COLLECT_LIST_KEYS})
+    collect_config.git = parse_git_list(data.get('git'), f"{where}.git", errors)
+    return collect_config
+
+
+def parse_run_section(data, where, errors):
+    """ runセクションを検証して RunConfig を作る（項目は文字列，または依存関係などを持つ辞書） """
+    if data is None:
+        return RunConfig()
+    if not isinstance(data, dict):
+        errors.append(f"{where}: 辞書で記述してください")
+        return RunConfig()
+
+    run_config = RunConfig(keys=[key for key in RUN_KEYS if key in data])
+    for key in RUN_KEYS:
+        value = data.get(key)
+        if value is None:
+            continue
+        if not isinstance(value, list):
+            errors.append(f"{where}.{key}: リストで記述してください")
+            continue
+
+        entries = []
+        for index, entry in enumerate(value):
+            entry_where = f"{where}.{key}[{index}]"
+            if entry is None:
+                continue
+            if isinstance(entry, str):
+                entries.append(entry.strip())
+            elif isinstance(entry, dict):
+                unknown = [name for name in entry if name not in RUN_ENTRY_KEYS]
+                if unknown:
+                    errors.append(f"{entry_where}: 不明なキーがあります {unknown}")
+                if not entry.get('cmd') and not entry.get('name'):
+                    errors.append(f"{entry_where}: cmd がありません")
+                if not isinstance(entry.get('after') or [], list):
+                    errors.append(f"{entry_where}.after: リストで記述してください")
+                if not isinstance(entry.get('ready') or {}, dict):
+                    errors.append(f"{entry_where}.ready: 辞書で記述してください")
+                else:
+                    unknown = [kind for kind in entry.get('ready') or {} if kind not in READY_KINDS]
+                    if unknown:
+                        errors.append(f"{entry_where}.ready: 不明な判定があります {unknown} (使用できるもの: {READY_KINDS})")
+                entries.append(entry)
+            else:
+                errors.append(f"{entry_where}: 文字列または辞書で記述してください ({entry!r})")
+        setattr(run_config, key, entries)
+    return run_config
+
+
+def load_robot_config(robot_path):
+    """ ロボットファイルを1回だけ読み込み，検証して RobotConfig を作る """
+    data = load_yaml(robot_path)
+    errors = []
+    if not isinstance(data, dict):
+        raise ConfigError(f"{robot_path}: ロボットファイルの形式が正しくありません")
+
+    collect_config = parse_collect_section(data.get('collect'), 'collect', errors)
+    run_config = parse_run_section(data.get('run'), 'run', errors)
+    param = data.get('Param') or {}
+    if not isinstance(param, dict):
+        errors.append("Param: 辞書で記述してください")
+        param = {}
+    if len(collect_config.engine) > 1:
+        print(f"collect.engine が複数あります．{collect_config.engine[0]} を使用します")
+
+    if errors:
+        raise ConfigError('\n'.join(f"{robot_path}: {error}" for error in errors))
+    return RobotConfig(robot_path, collect_config, run_config, param)
+
+
+def load_collect_config(yml_path):
+    """ collect用のyaml(統合collectファイルなど)を読み込む """
+    errors = []
+    data = load_yaml(yml_path) or {}
+    collect_config = parse_collect_section(data.get('collect') if isinstance(data, dict) else None, 'collect', errors)
+    if errors:
+        raise ConfigError('\n'.join(f"{yml_path}: {error}" for error in errors))
+    return collect_config
+
+
+def load_run_config(yml_path):
+    """ run用のyaml(Launch.yamlなど)を読み込む """
+    errors = []
+    data = load_yaml(yml_path) or {}
+    run_config = parse_run_section(data.get('run') if isinstance(data, dict) else None, 'run', errors)
+    if errors:
+        raise ConfigError('\n'.join(f"{yml_path}: {error}" for error in errors))
+    return run_config
+
+
+def load_scenario(scenario_path):
+    """ シナリオファイルを読み込み，検証して Scenario を作る """
+    data = load_yaml(scenario_path)
+    errors = []
+    tasks = []
+    scenario = data.get('scenario') if isinstance(data, dict) else None
+    if not isinstance(scenario, list):
+        errors.append("scenario: タスクのリストがありません")
+        scenario = []
+    elif not scenario:
+        errors.append("scenario: タスクが1つもありません")
+
+    for index, item in enumerate(scenario):
+        if not isinstance(item, dict) or not isinstance(item.get('task'), str) or not item['task']:
+            errors.append(f"scenario[{index}]: task がありません")
+            continue
+        tasks.append(ScenarioTask(item['task'], item.get('act'), item.get('arg')))
+
+    if errors:
+        raise ConfigError('\n'.join(f"{scenario_path}: {error}" for error in errors))
+    return Scenario(scenario_path, tasks)
 
 def join_yaml(_list, item):
     _list.append(item)
     return _list
 
+############################### パッケージ照会のキャッシュ・オフライン索引 ##############################
+def load_lookup_cache(cache_path, ttl=LOOKUP_CACHE_TTL):
+    """ 照会結果のキャッシュを読み込む（期限切れのエントリは捨てる） """
+    entries = load_json(cache_path)
+    now = time.time()
+    return {key: entry for key, entry in entries.items() if now - entry.get('time', 0) < ttl}
+
+
+def load_json(path, default=None):
+    """ JSONファイルを読み込む（無い・壊れている場合はdefaultを返す） """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {} if default is None else default
+
+
+def save_json(path, data):
+    """ JSONファイルを一時ファイル経由で置き換える """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # スレッドごとに別の一時ファイルを使う（同じパスへの同時保存で名前が衝突しないように）
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(path))
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def normalize_pypi_name(name):
+    """ PyPIのパッケージ名を正規化する(PEP 503) """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def read_apt_lists(lists_dir='/var/lib/apt/lists'):
+    """ aptのパッケージリストからパッケージ名を取り出す """
+    names = set()
+    for list_file in glob.glob(os.path.join(lists_dir, '*_Packages')):
+        with open(list_file, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if line.startswith('Package: '):
+                    names.add(line[len('Package: '):].strip())
+    return names
+
+
+def load_offline_index(index_dir):
+    """
+    オフライン照会用のパッケージ索引を読み込む．
+
+    index_dir/pypi_names.txt  PyPIのパッケージ名一覧（1行1件）
+    index_dir/apt_names.txt   aptのパッケージ名一覧（1行1件．無ければ /var/lib/apt/lists を解析する）
+    """
+    index = {'pip': set(), 'apt': set()}
+
+    for kind, filename in (('pip', 'pypi_names.txt'), ('apt', 'apt_names.txt')):
+        path = os.path.join(index_dir, filename)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                index[kind] = {line.strip() for line in f if line.strip()}
+
+    index['pip'] = {normalize_pypi_name(name) for name in index['pip']}
+    if not index['apt']:
+        index['apt'] = read_apt_lists()
+    return index
+
+
+def update_offline_index(index_dir):
+    """ PyPIの簡易インデックスとaptのリストからオフライン索引を作成する """
+    import requests
+
+    os.makedirs(index_dir, exist_ok=True)
+
+    response = requests.get("https://pypi.org/simple/", headers={'Accept': 'application/vnd.pypi.simple.v1+json'}, timeout=120)
+    response.raise_for_status()
+    pypi_names = sorted(project['name'] for project in response.json()['projects'])
+    with open(os.path.join(index_dir, 'pypi_names.txt'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(pypi_names) + '\n')
+
+    apt_names = sorted(read_apt_lists())
+    with open(os.path.join(index_dir, 'apt_names.txt'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(apt_names) + '\n')
+
+    print(f"オフライン索引を作成しました: PyPI {len(pypi_names)}件, apt {len(apt_names)}件 -> {index_dir}")
+
+
 ############################### スクリプトの依存関係を解析 ##############################
-def analyze_script_dependencies(script_path, special_modules=None, ros_modules=None, ros_modules_add=None):
+@traced
+def analyze_script_dependencies(script_path, special_modules=None, ros_modules=None, ros_modules_add=None,
+                                offline=False, index_dir=None, cache_ttl=LOOKUP_CACHE_TTL, imported_modules=None):
     """
     スクリプトの依存関係を解析し、標準ライブラリ、ROS関連ライブラリ、
     外部ライブラリ（pipでインストール可能/不可）に分類する。
@@ -36,6 +600,10 @@ def analyze_script_dependencies(script_path, special_modules=None, ros_modules=N
         special_modules (dict): 特別に扱いたいモジュール（例: {'module_name': 'pip_package_name'}）
         ros_modules (list): ROS関連のモジュール名リスト（desktop-fullに含まれるもの）
         ros_modules_add (list): ROS関連のモジュール名リスト（desktop-fullに含まれないもの）
+        offline (bool): Trueの場合はネットワークに接続せず，キャッシュとオフライン索引だけで判定する
+        index_dir (str): オフライン索引のディレクトリ（既定: {cache_dir}/index）
+        cache_ttl (float): PyPI/aptの照会結果をキャッシュする期間[s]
+        imported_modules (list): 解析済みのimportモジュール名（指定時はscript_pathを読まない）
 
     Returns:
         dict: 標準ライブラリ、ROS関連ライブラリ、pipインストール可能/不可の外部ライブラリを含む辞書
@@ -57,53 +625,78 @@ def analyze_script_dependencies(script_path, special_modules=None, ros_modules=N
 
     standard_libs_path = sysconfig.get_paths()["stdlib"]
 
-    def is_apt_installable(module_name):
-        """APTでインストール可能かどうかを確認"""
+    if index_dir is None:
+        index_dir = os.path.join(cache_dir, 'index')
+    cache_path = os.path.join(cache_dir, 'lookup_cache.json')
+    lookup_cache = load_lookup_cache(cache_path, cache_ttl)
+    cache_size = len(lookup_cache)
+    offline_index = load_offline_index(index_dir) if offline else None
+
+    def cached_lookup(kind, module_name, lookup):
+        """キャッシュ → (オフライン時)索引 → ネットワークの順に照会する"""
+        key = f"{kind}:{module_name}"
+        if key in lookup_cache:
+            return lookup_cache[key]['found']
+        if offline:
+            return lookup(module_name, offline_index[kind])
+        found = lookup(module_name, None)
+        if found is not None:
+            lookup_cache[key] = {'found': found, 'time': time.time()}
+        return bool(found)
+
+    def apt_lookup(module_name, index):
+        if index is not None:
+            candidates = [module_name, f"python3-{module_name}", f"python3-{module_name.replace('_', '-')}"]
+            return any(candidate.lower() in index for candidate in candidates)
         try:
-            result = subprocess.run(
+            result = run_command(
                 ["apt-cache", "search", module_name],
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
             )
             return bool(result.stdout.strip())  
         except Exception as e:
             print(f"Error checking {module_name} in APT: {e}")
-            return False
+            return None
+
+    def pip_lookup(module_name, index):
+        if index is not None:
+            return normalize_pypi_name(module_name) in index
+        import requests
+        url = f"https://pypi.org/pypi/{module_name}/json"
+        try:
+            response = requests.get(url, timeout=10)
+        except requests.RequestException as e:
+            print(f"Error checking {module_name} in PyPI: {e}")
+            return None
+        return response.status_code == 200
+
+    def is_apt_installable(module_name):
+        """APTでインストール可能かどうかを確認"""
+        return cached_lookup('apt', module_name, apt_lookup)
 
     def is_standard_lib(module_name):
         """標準ライブラリかどうかを判定"""
+        if module_name in sys.builtin_module_names or module_name in getattr(sys, 'stdlib_module_names', ()):
+            return True
         try:
             module_spec = importlib.util.find_spec(module_name)
             if module_spec is None or not module_spec.origin:
                 return False
+            if 'site-packages' in module_spec.origin or 'dist-packages' in module_spec.origin:
+                return False
             return module_spec.origin.startswith(standard_libs_path)
         except ModuleNotFoundError:
             return False
 
     def is_pip_installable(module_name):
         """PyPIでパッケージが存在するかを確認し、結果に基づいて変数を設定する"""
-        url = f"https://pypi.org/pypi/{module_name}/json"
-        response = requests.get(url)
-
         if module_name == "modules" or module_name == "time":
             return False
 
-        if response.status_code == 200:
-            return True         
-
-        else:
-            return False
+        return cached_lookup('pip', module_name, pip_lookup)
 
-    imported_modules = []
-
-    with open(script_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith("import "):
-                module = line.split()[1].split('.')[0]
-                imported_modules.append(module)
-            elif line.startswith("from "):
-                module = line.split()[1].split('.')[0]
-                imported_modules.append(module)
+    if imported_modules is None:
+        imported_modules = scan_imports(script_path)['absolute']
     imported_modules = list(set(imported_modules))
 
     standard_dependencies = []
@@ -146,6 +739,8 @@ def analyze_script_dependencies(script_path, special_modules=None, ros_modules=N
             else:
                 not_pip_installable.append(module)
 
+    if len(lookup_cache) != cache_size:
+        save_json(cache_path, lookup_cache)
 
     return {
         "standard_libraries": standard_dependencies,
@@ -157,22 +752,184 @@ def analyze_script_dependencies(script_path, special_modules=None, ros_modules=N
     }
 
 
+############################### importの解析(ast) ##############################
+def scan_imports(script_path):
+    """
+    astでスクリプトを解析し，importしているモジュールを返す．
+    try/except内や関数内のimport，`import a, b` の形式も対象にする．
+
+    Returns:
+        dict: path, absolute(トップレベルのモジュール名), relative(相対importのモジュール名), error
+    """
+    result = {'path': script_path, 'absolute': [], 'relative': [], 'error': None}
+    try:
+        with open(script_path, 'rb') as f:
+            tree = ast.parse(f.read(), filename=script_path)
+    except (OSError, SyntaxError, ValueError) as e:
+        result['error'] = str(e)
+        return result
+
+    absolute = set()
+    relative = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                absolute.add(alias.name.split('.')[0])
+        elif isinstance(node, ast.ImportFrom):
+            if node.level == 0:
+                absolute.add(node.module.split('.')[0])
+            elif node.module:
+                relative.add(node.module.split('.')[0])
+            else:
+                relative.update(alias.name for alias in node.names)
+
+    result['absolute'] = sorted(absolute)
+    result['relative'] = sorted(relative)
+    return result
+
+
+@traced
+def scan_engine_package(engine, jobs=None):
+    """ engineパッケージ内の全.pyファイルをプロセスプールで並列に解析する """
+    package_dir = os.path.join(ros_ws, "src", engine)
+    py_files = []
+    for root, dirs, files in os.walk(package_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d not in ('build', 'devel', '__pycache__')]
+        py_files.extend(os.path.join(root, name) for name in sorted(files) if name.endswith('.py'))
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        scans = list(executor.map(scan_imports, py_files, chunksize=8))
+
+    for scan in scans:
+        if scan['error']:
+            print(f"解析できませんでした: {scan['path']}: {scan['error']}")
+
+    return {scan['path']: scan for scan in scans}
+
+
+def local_module_files(scans):
+    """ パッケージ内で定義されているモジュール名 → ファイルの対応を作る（Pythonパッケージは配下の全ファイル） """
+    modules = {}
+    for path in scans:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name == '__init__':
+            package_dir = os.path.dirname(path)
+            members = [p for p in scans if p.startswith(package_dir + os.sep)]
+            modules.setdefault(os.path.basename(package_dir), []).extend(members)
+        else:
+            modules.setdefault(name, []).append(path)
+    return modules
+
+
+def function_imports(entry_path, scans, modules):
+    """ HRI機能のスクリプトから辿れるパッケージ内モジュールを含め，外部モジュールを集める """
+    external = set()
+    visited = set()
+    pending = [entry_path]
+    while pending:
+        path = pending.pop()
+        if path in visited or path not in scans:
+            continue
+        visited.add(path)
+
+        scan = scans[path]
+        for module in scan['absolute']:
+            if module in modules:
+                pending.extend(modules[module])
+            else:
+                external.add(module)
+        for module in scan['relative']:
+            base = os.path.dirname(path)
+            pending.extend(p for p in modules.get(module, []) if p.startswith(base))
+
+    return sorted(external)
+
+
+def find_function_scripts(scans, modules, functions=None):
+    """
+    HRI機能名 → スクリプトの対応を返す．
+    functionsを省略した場合は，パッケージ内の他のファイルからimportされていないスクリプトを全て対象にする．
+    """
+    if functions is None:
+        imported = set()
+        for scan in scans.values():
+            imported.update(scan['absolute'])
+            imported.update(scan['relative'])
+        # Pythonパッケージ内のモジュールや解析できなかったファイルは対象外
+        package_members = {path for path in scans
+                           if os.path.exists(os.path.join(os.path.dirname(path), '__init__.py'))}
+        functions = sorted(name for name, paths in modules.items()
+                           if name not in imported and not name.startswith('_')
+                           and any(path not in package_members and not scans[path]['error'] for path in paths))
+
+    scripts = {}
+    for function in functions:
+        candidates = [path for path in modules.get(function, []) if path.endswith(f"{function}.py")]
+        if candidates:
+            # scripts/ 以下にあるものを優先する
+            candidates.sort(key=lambda path: (os.sep + 'scripts' + os.sep not in path, path))
+            scripts[function] = candidates[0]
+        else:
+            print(f"HRI機能 {function} のスクリプトが見つかりません")
+    return scripts
+
+
+def dependencies_to_collect(dependencies):
+    """ analyze_script_dependencies の結果を collect 用の形式に変換する """
+    ros_distro = os.environ.get('ROS_DISTRO', 'noetic')
+    aptros = [f"ros-{ros_distro}-{package.replace('_', '-')}" for package in dependencies['ros_additional_libraries']]
+    return {'collect': {
+        'rtm': [],
+        'apt': sorted(dependencies['apt_installable']) + sorted(aptros),
+        'pip': sorted(dependencies['pip_installable']),
+        'git': [],
+        'other': sorted(dependencies['not_pip_installable']),
+    }}
+
+
+@traced
+def generate_collect_fragments(engine, functions=None, jobs=None, offline=False, force=False, index_dir=None):
+    """
+    engineパッケージを解析し，HRI機能ごとの yaml/<function>.yaml (collect用) を生成する．
+    既存のファイルには依存関係を追記し，force=True の場合は作り直す．
+    offline=True の場合は index_dir のオフライン索引を使う（None なら {cache_dir}/index）．
+    """
+    scans = scan_engine_package(engine, jobs)
+    modules = local_module_files(scans)
+    scripts = find_function_scripts(scans, modules, functions)
+
+    yaml_dir = os.path.join(ros_ws, "src", engine, "yaml")
+    os.makedirs(yaml_dir, exist_ok=True)
+
+    generated = []
+    for function, script in scripts.items():
+        external = function_imports(script, scans, modules)
+        dependencies = analyze_script_dependencies(script, offline=offline, index_dir=index_dir,
+                                                   imported_modules=external)
+        fragment = os.path.join(yaml_dir, f"{function}.yaml")
+
+        if force or not os.path.exists(fragment):
+            with open(fragment, 'w', encoding='utf-8') as f:
+                yaml.dump(dependencies_to_collect(dependencies), f, sort_keys=False, default_flow_style=False, allow_unicode=True)
+        else:
+            update_yaml_with_dependencies(fragment, dependencies_to_collect(dependencies), fragment)
+
+        print(f"{function}: {fragment}")
+        generated.append(fragment)
+
+    return generated
+
+
 ############################### スクリプトの依存関係を追加 ##############################
 def update_yaml_with_dependencies(yaml_path1, dependencies , yaml_path2):
     """ 既存のYAMLに新しい依存関係を追加 """
-    existing_data = load_yaml(yaml_path1) if os.path.exists(yaml_path1) else {}
-    if os.path.exists(yaml_path1):
-        with open(yaml_path1, 'r') as yaml_file:
-            existing_data = yaml.safe_load(yaml_file) or {}
-    else:
-        existing_data = {}
+    existing_data = (load_yaml(yaml_path1) or {}) if os.path.exists(yaml_path1) else {}
 
     if "collect" in existing_data:
-        existing_data["collect"]["rtm"].extend(dependencies["collect"]["rtm"])
-        existing_data["collect"]["apt"].extend(dependencies["collect"]["apt"])
-        existing_data["collect"]["pip"].extend(dependencies["collect"]["pip"])
-        existing_data["collect"]["git"].extend(dependencies["collect"]["git"])
-        existing_data["collect"]["other"].extend(dependencies["collect"]["other"])
+        for key in ["rtm", "apt", "pip", "git", "other"]:
+            items = [item for item in existing_data["collect"].get(key) or [] if item is not None]
+            items.extend(item for item in dependencies["collect"][key] if item not in items)
+            existing_data["collect"][key] = items
     else:
         existing_data["collect"] = dependencies["collect"]
 
@@ -190,23 +947,20 @@ def filter_empty_items(items):
         return {k: v for k, v in items.items() if v is not None}
     return items
 
-def load_yaml(file):
-    """ YAMLファイルを読み込むヘルパー関数（仮定） """
-    with open(file, 'r', encoding='utf-8') as f:
-        return yaml.safe_load(f)
-
-def combined_collectfile(files):
+@traced
+def combined_collectfile(files, work_dir=None):
     """ 複数のYAMLファイルを統合する（collect用） """
 
-    combined_file = 'combined_collect.yaml'
+    combined_file = os.path.join(work_dir or cache_dir, 'combined_collect.yaml')
     combined_data = {'collect': {key: [] for key in ["rtm", "apt", "pip", "git", "other"]}}
 
     for file in files:
-        data = load_yaml(file)
+        fragment = load_collect_config(file)
         for key in ["rtm", "apt", "pip", "other"]:
-            combined_data['collect'][key] = list(set(combined_data['collect'][key] + data.get('collect', {}).get(key, [])))
-        combined_data['collect']['git'].extend(repo for repo in data.get('collect', {}).get('git', []) if repo.get('url'))
+            combined_data['collect'][key] = unique_items(combined_data['collect'][key] + getattr(fragment, key))
+        combined_data['collect']['git'].extend(asdict(repo) for repo in fragment.git)
 
+    os.makedirs(work_dir or cache_dir, exist_ok=True)
     with open(combined_file, 'w', encoding='utf-8') as output_file:
         yaml.dump(combined_data, output_file, allow_unicode=True, sort_keys=False)
 
@@ -216,61 +970,34 @@ def combined_collectfile(files):
 
 
 # run用のyamlを合成する関数
-def combined_runfile(files):
-    combined_file = 'Launch.yaml'
+@traced
+def combined_runfile(files, work_dir=None):
+    combined_file = os.path.join(work_dir or cache_dir, 'Launch.yaml')
 
     """ 複数のYAMLファイルを統合する（run用） """
     combined_data = {'run': {key: [] for key in ["rtm", "rosrun", "roslaunch"]}}
 
     for file in files:
-        data = load_yaml(file)
+        fragment = load_run_config(file)
         for key in ["rtm", "rosrun", "roslaunch"]:
-            combined_data['run'][key] = list(set(combined_data['run'][key] + data.get('run', {}).get(key, [])))
+            # 依存関係などを辞書で書いた項目もあるため set ではなく順番を保って重複を除く
+            for item in getattr(fragment, key):
+                if item not in combined_data['run'][key]:
+                    combined_data['run'][key].append(item)
 
+    os.makedirs(work_dir or cache_dir, exist_ok=True)
     with open(combined_file, 'w', encoding='utf-8') as output_file:
         yaml.dump(combined_data, output_file, allow_unicode=True, sort_keys=False)
 
     return combined_file
 
-    
-# yamlファイルを編集(項目の削除)
-def item_replace_null(output_file, route_key, keys_to_replace):
-    
-    with open(output_file, 'r') as infile:
-        data = yaml.safe_load(infile)
-
-    if route_key in data:
-        for key in keys_to_replace:
-            if key in data[route_key]:
-                data[route_key][key] = [None] 
-
-    with open(output_file, "w") as file:
-        yaml.dump(data, file, default_flow_style=False)
-
-    return output_file
-
-
-# hri-c用のlaunchのyamlを作成する
-def update_yaml_launch_file(launch_files):
-    
-    script_path = os.path.join(home_path, rtsi_dir)
-    os.chdir(script_path)
-
- 
-    subprocess.run(["pwd"])
-
-    output_file = "seed_hri.yaml"
-    keys_to_replace = ['rtm','roslaunch', 'rosrun']
-    route_key = 'run'
 
-    output_file = item_replace_null(output_file, route_key, keys_to_replace)
-    
-    with open(output_file , 'r') as infile:
-        data = yaml.safe_load(infile)
+# hri-c用のlaunchのyamlを作成する（チェックアウト内のファイルは書き換えず，キャッシュに出力する）
+@traced
+def update_yaml_launch_file(launch_files, work_dir=None):
 
-    data['run']['rtm'] = [item for item in data['run']['rtm'] if item is not None]
-    data['run']['roslaunch'] = [item for item in data['run']['roslaunch'] if item is not None]
-    data['run']['rosrun'] = [item for item in data['run']['rosrun'] if item is not None]
+    output_file = os.path.join(work_dir or cache_dir, "hri_run.yaml")
+    data = {'run': {'rtm': [], 'roslaunch': [], 'rosrun': []}}
 
     for script in launch_files:
         if '.launch' in script:
@@ -280,6 +1007,7 @@ def update_yaml_launch_file(launch_files):
             if script not in data['run']['rosrun']:  
                 data['run']['rosrun'].append(script)
 
+    os.makedirs(work_dir or cache_dir, exist_ok=True)
     with open(output_file, 'w') as outfile:
         yaml.dump(data, outfile, sort_keys=False, default_flow_style=False)
 
@@ -288,7 +1016,8 @@ def update_yaml_launch_file(launch_files):
     return output_file
 
 # 分析のメイン処理(collect)
-def analyze(engine,functions):
+@traced
+def analyze(engine,functions, jobs=None, offline=False, work_dir=None, index_dir=None):
 
     collect_list = []
 
@@ -298,14 +1027,37 @@ def analyze(engine,functions):
     if engine == "None":
         return None
 
-    files_list = [os.path.join(home_path, "catkin_ws", "src", engine, "yaml", f"{file}.yaml") for file in functions]
+    # collect用のyamlが無いHRI機能はスクリプトを解析して生成する
+    indexed = engine_catalog().get(engine, {}).get('functions', {})
+    missing = [function for function in functions if not indexed.get(function, {}).get('collect')]
+    if missing:
+        print(f"collect用のyamlを生成します: {missing}")
+        generate_collect_fragments(engine, missing, jobs, offline, index_dir=index_dir)
+        indexed = engine_catalog().get(engine, {}).get('functions', {})
+    files_list = [indexed[function]['collect'] for function in functions if indexed.get(function, {}).get('collect')]
+
+    return combined_collectfile(files_list, work_dir)
 
-    return combined_collectfile(files_list)
 
 
+def planned_dependencies(engine, functions):
+    """
+    collect --dry-run 用: 既存の collect用yaml だけから依存関係(CollectConfig)を求める．
+    スクリプトの解析・yamlの生成・パッケージの照会は行わず，ファイルも書き込まない．
+    """
+    if engine == "None":
+        return CollectConfig()
+    indexed = engine_catalog(save=False).get(engine, {}).get('functions', {})
+    missing = [function for function in functions if not indexed.get(function, {}).get('collect')]
+    if missing:
+        print(f"collect用のyamlが無いHRI機能（collect 時にスクリプトを解析します．計画には含まれません）: {missing}")
+    return merge_collect_configs([load_collect_config(indexed[function]['collect'])
+                                  for function in functions if indexed.get(function, {}).get('collect')])
+
 
 ################################ 分析のメイン処理(run) ###############################
-def analyze2(engine_name, robot_path, functions):
+@traced
+def analyze2(engine_name, robot_path, functions, work_dir=None):
 
     hri_script = []
     launch_list = []
@@ -322,417 +1074,3270 @@ def analyze2(engine_name, robot_path, functions):
             _file = engine_name + ' ' + launch_file + ".py"
             hri_script = join_yaml(hri_script, _file)
   
-    yaml_file = update_yaml_launch_file(hri_script)
+    yaml_file = update_yaml_launch_file(hri_script, work_dir)
 
     launch_list = join_yaml(launch_list, yaml_file)
 
-    aaa = combined_runfile(launch_list) 
+    aaa = combined_runfile(launch_list, work_dir) 
 
     return aaa
 
 ############################### Engineのノード名を取得する ###############################
+@traced
 def get_enginefile(engine_name):
     print(engine_name)
-    directory = ros_ws + "/src/" + engine_name + "/hri.xml"
-
-    tree = ET.parse(directory)
-    root = tree.getroot()
-    namespaces = {
-        'gml': 'http://example.com/r/gml',
-        'rois': 'http://example.com/r/rois'
-    }
-
-    filename = root.find('gml:filename', namespaces)
-    if filename is not None:
-        filename_text = filename.text + ".py" 
+    # hri.xml は毎回読まずに engine の索引(gml:filename)を使う
+    entry = engine_catalog().get(engine_name)
+    if entry is not None and entry['filename']:
+        filename_text = entry['filename'] + ".py" 
         engine = engine_name +' ' + filename_text
         return engine
     else:
         return "None"
-    
-def collect(yml_path):
 
-    if  yml_path == None:
-        return
-    with open(yml_path , 'r') as yml:
-        config = yaml.safe_load(yml)
-    
- ######### wasanbon repository #####################    
-    os.chdir(rtm_ws)
-    rtm_item = config.get('collect', {}).get('rtm', [])
-    leng_rtm = [item for item in rtm_item if item is not None]
-    length_rtm = len(leng_rtm)
-    print(f"wasanbonパッケージの個数: {length_rtm}")
 
+############################## HRI engineの索引・シナリオの検証 ##############################
+# hri.xml の名前空間
+HRI_NAMESPACES = {
+    'gml': 'http://example.com/r/gml',
+    'rois': 'http://example.com/r/rois'
+}
+# 索引の形式を変えた場合は番号を上げてキャッシュを無効にする
+ENGINE_CATALOG_VERSION = 1
 
-    if length_rtm == 0:
-        print("rtm pass")
-        pass
-    else:
-        print("install wasanbon repository")
-        for i in range(length_rtm):
-            was_rep1 = config['collect']['rtm'][i]
-            print(was_rep1)
-            ser_rtm = './{}'.format(was_rep1)
-            if os.path.isdir(ser_rtm):
-                print("rtm File exit already")
-            else:
-                was_rep11 = 'wasanbon-admin.py repository clone {} -v' .format(was_rep1)
-                print(was_rep11)
-                call(was_rep11.split())
 
- ######### engine repository #####################    
-    path_ros = ros_ws + "/src/"
-    os.chdir(path_ros)
-    engine_item = config.get('collect', {}).get('engine', [])
-    leng_engine = [item for item in engine_item if item is not None]
-    length_engine = len(leng_engine)
-    print(f"hri engineパッケージの個数: {length_engine}")
-
-    if length_engine == 0:
-        print("engine pass")
-        pass
-    else:
-        print("install engine repository")
-        for i in range(length_engine):
-            was_rep1 = config['collect']['engine'][i]
-            print(was_rep1)
-            ser_engine = './{}'.format(was_rep1)
-            if os.path.isdir(ser_engine):
-                print("engine File exit already")
-            else:
-                was_rep11 = 'wasanbon-admin.py repository clone {} -v' .format(was_rep1)
-                print(was_rep11)
-                call(was_rep11.split())
+def index_engine(engine_dir):
+    """
+    engineパッケージを1つ索引する．
+    hri.xml の gml:filename，HRI機能(スクリプト)ごとのスクリプトと collect用yaml(yaml/<機能>.yaml) を記録し，
+    走査したディレクトリと hri.xml の更新時刻を索引が有効かの判定に使う．
+    """
+    signature = {}
+    scripts = {}
+    fragments = {}
+    yaml_dir = os.path.join(engine_dir, 'yaml')
+    for root, dirs, files in os.walk(engine_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d not in ('build', 'devel', '__pycache__'))
+        signature[root] = os.stat(root).st_mtime_ns
+        for name in sorted(files):
+            stem, ext = os.path.splitext(name)
+            if ext == '.py' and not stem.startswith('_'):
+                scripts.setdefault(stem, []).append(os.path.join(root, name))
+            elif ext == '.yaml' and root == yaml_dir:
+                fragments[stem] = os.path.join(root, name)
+
+    hri_xml = os.path.join(engine_dir, 'hri.xml')
+    signature[hri_xml] = os.stat(hri_xml).st_mtime_ns
+    try:
+        filename = ET.parse(hri_xml).getroot().findtext('gml:filename', None, HRI_NAMESPACES)
+    except ET.ParseError as e:
+        print(f"{hri_xml} を読み込めませんでした: {e}")
+        filename = None
+
+    functions = {}
+    for name in sorted(set(scripts) | set(fragments)):
+        # scripts/ 以下にあるものを優先する（find_function_scripts と同じ）
+        candidates = sorted(scripts.get(name, []), key=lambda path: (os.sep + 'scripts' + os.sep not in path, path))
+        functions[name] = {'script': candidates[0] if candidates else None, 'collect': fragments.get(name),
+                           'run': f"{os.path.basename(engine_dir)} {name}.py" if candidates else None}
+    return {'signature': signature, 'filename': filename and filename.strip(), 'functions': functions}
+
+
+def signature_valid(signature):
+    """ 記録した更新時刻から変わっていなければTrue """
+    try:
+        return all(os.stat(path).st_mtime_ns == mtime for path, mtime in signature.items())
+    except OSError:
+        return False
+
+
+@traced
+def engine_catalog(save=True):
+    """
+    ワークスペースの HRI engine（src/<engine>/hri.xml のあるパッケージ）の索引: engine名 → index_engine() の結果．
+    キャッシュに保存し，更新時刻が変わった engine だけを索引し直す（save=False の場合は保存しない）．
+    """
+    src_dir = os.path.join(ros_ws, "src")
+    catalog_path = os.path.join(cache_dir, 'engine_catalog.json')
+    catalog = load_json(catalog_path)
+    if catalog.get('version') != ENGINE_CATALOG_VERSION or catalog.get('workspace') != src_dir:
+        catalog = {'version': ENGINE_CATALOG_VERSION, 'workspace': src_dir, 'engines': {}}
 
- ######### apt repository #####################
+    try:
+        names = sorted(entry.name for entry in os.scandir(src_dir)
+                       if entry.is_dir() and os.path.exists(os.path.join(entry.path, 'hri.xml')))
+    except OSError:
+        names = []
 
-    apt_item = config.get('collect', {}).get('apt', [])
-    leng_apt = [item for item in apt_item if item is not None]
-    length_apt = len(leng_apt)
-    print(f"aptの個数: {length_apt}")
+    engines = {}
+    for name in names:
+        cached = catalog['engines'].get(name)
+        engines[name] = cached if cached and signature_valid(cached['signature']) else index_engine(os.path.join(src_dir, name))
 
-    if length_apt == 0:
-        print("apt pass")
-        pass
-    else:
+    if save and engines != catalog['engines']:
+        catalog['engines'] = engines
+        save_json(catalog_path, catalog)
+    return engines
 
-        for i in range(length_apt):
-            ccc = config['collect']['apt'][i]
-            print(ccc)
-            install = "sudo -S apt -y install  {}".format(ccc)
-            password = "rsdlab\n".encode()
-            subprocess.run(install.split(), input=password)
-
- ######### pip repository #####################
-    pip_item = config.get('collect', {}).get('pip', [])
-    leng_pip = [item for item in pip_item if item is not None]
-    length_pip = len(leng_pip)
-    print(f"pipの個数: {length_pip}")
-
-    if length_pip == 0:
-        print("pip pass")
-        pass
-    else:
 
-        for i in range(length_pip):
-            ccc = config['collect']['pip'][i]
-            print(ccc)
+def close_matches(name, candidates):
+    """ 似た名前の候補（綴りの誤りの指摘用） """
+    matches = difflib.get_close_matches(str(name), list(candidates), n=3, cutoff=0.6)
+    return f"（もしかして: {', '.join(matches)}）" if matches else ''
 
-            subprocess.run([ 'pip', 'install', str(ccc)])
 
- ######### ros package #####################
-    dir_name = f"{ros_ws}/src" 
-    os.chdir(dir_name)
+def validate_scenario(robot, scenario, catalog=None):
+    """
+    ロボットファイルの engine とシナリオのHRI機能が存在するかを engine の索引で検証し，エラーのリストを返す．
+    collect・build・run の前に呼び，シナリオの誤りを時間のかかる処理より先に見つける．
+    """
+    if robot.engine == "None":
+        return []
+    catalog = engine_catalog() if catalog is None else catalog
+    entry = catalog.get(robot.engine)
+    if entry is None:
+        return [f"{robot.path}: HRI engine {robot.engine} がありません（{ros_ws}/src/{robot.engine}/hri.xml）"
+                f"{close_matches(robot.engine, catalog)}"]
+
+    available = [name for name, function in entry['functions'].items() if function['script']]
+    errors = []
+    for index, task in enumerate(scenario.tasks):
+        if task.task in available or any(task.task == other.task for other in scenario.tasks[:index]):
+            continue
+        errors.append(f"{scenario.path}: scenario[{index}]: HRI機能 {task.task} は {robot.engine} にありません"
+                      f"{close_matches(task.task, available)}")
+    return errors
+
+
+def warn_scenarios(contexts):
+    """
+    collect --dry-run 用: シナリオの誤りを警告として表示する（処理は止めない）．
+    engine が未取得で collect で clone する予定の場合は，検証を collect の実行時に回す．
+    """
+    catalog = engine_catalog(save=False)
+    for ctx in contexts:
+        if ctx.robot.engine not in catalog and ctx.robot.engine in ctx.robot.collect.engine:
+            print(f"{ctx.name}: HRI engine {ctx.robot.engine} は未取得のため，シナリオは collect の実行時に検証します")
+            continue
+        for error in validate_scenario(ctx.robot, ctx.scenario, catalog):
+            print(f"警告: {ctx.name}: {error}")
+
+
+def validate_context(ctx):
+    """ validate_scenario で誤りが見つかった場合は ConfigError にする """
+    errors = validate_scenario(ctx.robot, ctx.scenario)
+    if errors:
+        raise ConfigError('\n'.join(errors))
+
+############################## gitのミラーキャッシュ ##############################
+def git_mirror_path(url):
+    """ リポジトリのURLに対応するミラーのパス """
+    name = os.path.basename(str(url).rstrip('/'))
+    if not name.endswith('.git'):
+        name += '.git'
+    return os.path.join(git_mirror_dir, f"{hashlib.sha1(str(url).encode()).hexdigest()[:12]}-{name}")
+
+
+@contextmanager
+def git_mirror_lock(mirror):
+    """ 同じミラーを複数のプロセス・スレッドから同時に更新しないようにする """
+    os.makedirs(git_mirror_dir, exist_ok=True)
+    with open(mirror + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
-    git_items = config.get('collect', {}).get('git', [])
-    repo_count = sum(1 for item in git_items if isinstance(item, dict) and 'url' in item and item['url'])
 
-    print(f"repoの個数: {repo_count}")
+@traced
+def update_git_mirror(url, offline=False):
+    """
+    ミラーを作成・更新する（問題があればエラーメッセージ，なければNoneを返す）．
+    ミラーが既にある場合は offline またはネットワークに繋がらない時でもそのまま使う．
+    """
+    mirror = git_mirror_path(url)
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+
+    with git_mirror_lock(mirror):
+        if os.path.isdir(mirror):
+            if not offline:
+                result = run_command(['git', '-C', mirror, 'fetch', '--prune', '--quiet', 'origin'], env=env,
+                                     stdin=subprocess.DEVNULL, capture_output=True, text=True)
+                if result.returncode != 0:
+                    print(f"ミラーを更新できませんでした．キャッシュを使用します: {url}")
+            return None
+
+        if offline:
+            return f"ミラーがありません（オフライン）: {url}"
+
+        # 途中で失敗したミラーが残らないように一時ディレクトリに clone してから移動する
+        partial = mirror + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        result = run_command(['git', 'clone', '--mirror', '--quiet', str(url), partial], env=env,
+                             stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode != 0:
+            shutil.rmtree(partial, ignore_errors=True)
+            tail = result.stdout.strip().splitlines()[-3:]
+            return f"ミラーを作成できません 終了コード {result.returncode}: " + ' / '.join(tail)
+
+        # ワークスペースは --reference でミラーのオブジェクトを参照するため，gcで削除しない
+        run_command(['git', '-C', partial, 'config', 'gc.pruneExpire', 'never'])
+        # 部分クローン(--git-filter)の取得元にできるようにする
+        run_command(['git', '-C', partial, 'config', 'uploadpack.allowFilter', 'true'])
+        os.rename(partial, mirror)
+    return None
+
+
+def git_clone_command(url, repo, branch=None, mirror=True, depth=None, filter_spec=None):
+    """
+    ワークスペースに clone するコマンドを作る．
+    ミラーを使う場合，通常はオブジェクトをミラーから参照(--reference)して複製しない．
+    depth(浅いクローン)・filter_spec(部分クローン)を指定した場合はミラーからgitのプロトコルで取得する．
+    """
+    command = ['git', 'clone']
+    if depth:
+        command += ['--depth', str(depth)]
+    if filter_spec:
+        command += ['--filter', str(filter_spec)]
+    if branch is not None:
+        command += ['-b', str(branch)]
+
+    source = str(url)
+    if mirror:
+        source = git_mirror_path(url)
+        if depth or filter_spec:
+            source = 'file://' + source
+        else:
+            command += ['--reference', source]
+    return command + [source, str(repo)]
 
-    if repo_count == 0:
-        print("git pass")
-        pass
 
+############################## 並列フェッチ ##############################
+def fetch_job(kind, name, command, cwd, dest, branch=None, mirror_url=None, offline=False):
+    """
+    フェッチ(clone)1件分の情報．
+    mirror_url がある場合は clone の前にミラーを更新し，clone 後に origin をそのURLに戻す．
+    """
+    return {'kind': kind, 'name': name, 'command': command, 'cwd': cwd, 'dest': dest, 'branch': branch,
+            'mirror_url': mirror_url, 'offline': offline}
+
+
+def check_fetched(job):
+    """ clone の完了を確認する（問題があればエラーメッセージ，なければNoneを返す） """
+    if not os.path.isdir(job['dest']):
+        return f"{job['dest']} が作成されていません"
+
+    if job['kind'] == 'git':
+        result = run_command(['git', '-C', job['dest'], 'rev-parse', '--abbrev-ref', 'HEAD'],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            return result.stderr.strip() or "git rev-parse に失敗しました"
+        if job['branch'] is not None and result.stdout.strip() != str(job['branch']):
+            return f"ブランチが {result.stdout.strip()} になっています（指定: {job['branch']}）"
+
+    return None
+
+
+def run_fetch_job(job):
+    """ フェッチを1件実行し，結果を返す """
+    start = time.monotonic()
+    if job['mirror_url']:
+        error = update_git_mirror(job['mirror_url'], job['offline'])
+        if error is not None:
+            return {'job': job, 'status': 'NG', 'error': error, 'elapsed': time.monotonic() - start}
+
+    # ブランチの切り替えなど，複数のコマンドを順に実行するものもある
+    commands = job['command'] if isinstance(job['command'][0], list) else [job['command']]
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    for command in commands:
+        print(' '.join(command))
+        result = run_command(command, cwd=job['cwd'], env=env, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode != 0:
+            break
+
+    if result.returncode != 0:
+        tail = result.stdout.strip().splitlines()[-3:]
+        error = f"終了コード {result.returncode}: " + ' / '.join(tail)
     else:
+        error = check_fetched(job)
 
-        for i in range(repo_count):
-            url = config['collect']['git'][i]['url']
-            repo = config['collect']['git'][i]['repo']
-            print(f"repository{i} name :{repo}")
-            branch = config['collect']['git'][i]['branch']
-            if branch == None:
-                pass
-
-            ser_git = f'{ros_ws}/src/'+ str(repo)
-            if os.path.isdir(ser_git):
-                print("repository exit already")
-            else:
-                if branch == None:
-                    print('clone repository' )
-                    subprocess.run(['git', 'clone', str(url)])
-                else:
-                    print('clone repository '+ str(branch))
-                    subprocess.run(['git', 'clone', '-b', str(branch) ,str(url)])
-                    time.sleep(15)
+    if error is None and job['mirror_url']:
+        # pull などはミラーではなく元のリポジトリから行う
+        run_command(['git', '-C', job['dest'], 'remote', 'set-url', 'origin', str(job['mirror_url'])])
 
-    ####################  Add  edit  modules(by editor) #####################
-    if length_rtm == 0:
-        print("rtm pass")
-        pass
-    else:
-        dec_b = config['collect']['rtm'][0]
-        if (dec_b == 'Destination_gui'):  
-            print("move system file")   
-            move_file()
-        else:
-            print("move file for navigation")
-    
- ######### add package ######################
-        dec = config['collect']['rtm'][0]
+    return {'job': job, 'status': 'OK' if error is None else 'NG', 'error': error,
+            'elapsed': time.monotonic() - start}
 
-        if (dec == 'MobileRobotControl'):  
-            print("install sfml")      
-            sfml()
-        else:
-            print("not install sfml")
 
+def print_fetch_summary(results):
+    """ フェッチ結果の一覧を表示する """
+    if not results:
+        return
+    print("------------------------- フェッチ結果 -------------------------")
+    for result in results:
+        job = result['job']
+        print(f"[{result['status']:4}] {job['kind']:6} {job['name']} ({result['elapsed']:.1f}s)")
+        if result['error']:
+            print(f"       {result['error']}")
+    failed = [result for result in results if result['status'] == 'NG']
+    print(f"成功: {len(results) - len(failed)}  失敗: {len(failed)}")
+
+
+############################## 導入済みの状態との照合(reconcile) ##############################
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+# 読み込んだインストール済みパッケージ（1回の実行で1回だけ読む．インストールした後は invalidate_installed で消す）
+installed_cache = {}
+
+
+def read_dpkg_status(status_path=DPKG_STATUS):
+    """ dpkgの状態ファイルからインストール済みのパッケージ {名前: バージョン} を読む（名前:アーキテクチャ も含む） """
+    packages = {}
+    try:
+        with open(status_path, 'r', encoding='utf-8', errors='replace') as f:
+            paragraphs = f.read().split('\n\n')
+    except OSError:
+        return packages
+
+    for paragraph in paragraphs:
+        fields = {}
+        for line in paragraph.splitlines():
+            if line and not line[0].isspace():
+                key, _, value = line.partition(':')
+                fields[key] = value.strip()
+        if fields.get('Package') and fields.get('Status', '').endswith(' installed'):
+            packages[fields['Package']] = fields.get('Version', '')
+            packages[f"{fields['Package']}:{fields.get('Architecture', '')}"] = fields.get('Version', '')
+    return packages
+
+
+def installed_python_distributions():
+    """ importlib.metadata からインストール済みのPythonパッケージ {正規化した名前: バージョン} を読む """
+    distributions = {}
+    for distribution in importlib.metadata.distributions():
+        name = distribution.metadata['Name']
+        if name:
+            distributions[normalize_pypi_name(name)] = distribution.version
+    return distributions
+
+
+def installed_packages(kind):
+    """ インストール済みのパッケージ（kind は 'apt' / 'pip'） """
+    if kind not in installed_cache:
+        installed_cache[kind] = read_dpkg_status() if kind == 'apt' else installed_python_distributions()
+    return installed_cache[kind]
+
+
+def invalidate_installed():
+    installed_cache.clear()
+
+
+def apt_satisfied(item, installed):
+    """ aptの項目（"名前" または "名前=バージョン"）がインストール済みか """
+    name, sep, version = str(item).partition('=')
+    return name in installed and (not sep or installed[name] == version)
+
+
+def pip_satisfied(requirement, installed):
+    """ pipの要求（"名前", "名前>=1.0" など）を満たすパッケージがインストール済みか """
+    if Requirement is None:
+        match = re.match(r'^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:==\s*([^\s;]+))?\s*$', str(requirement))
+        if not match:
+            return False
+        version = installed.get(normalize_pypi_name(match.group(1)))
+        return version is not None and (match.group(2) is None or version == match.group(2))
+
+    try:
+        parsed = Requirement(str(requirement))
+    except InvalidRequirement:
+        # URL・ローカルパスなどは判定できないため毎回インストールする
+        return False
+    if parsed.marker is not None and not parsed.marker.evaluate():
+        return True
+    version = installed.get(normalize_pypi_name(parsed.name))
+    if version is None or parsed.extras or parsed.url:
+        return False
+    return not parsed.specifier or parsed.specifier.contains(version, prereleases=True)
+
+
+def reconcile_packages(apt_list, pip_list):
+    """ インストール済みのものを除き，インストールが必要な apt/pip の項目だけを返す """
+    apt_missing = [item for item in apt_list if not apt_satisfied(item, installed_packages('apt'))] if apt_list else []
+    pip_missing = [item for item in pip_list if not pip_satisfied(item, installed_packages('pip'))] if pip_list else []
+    satisfied = len(apt_list) - len(apt_missing) + len(pip_list) - len(pip_missing)
+    if satisfied:
+        print(f"インストール済みのためスキップ: apt {len(apt_list) - len(apt_missing)}件, "
+              f"pip {len(pip_list) - len(pip_missing)}件")
+    return apt_missing, pip_missing
+
+
+def git_head_branch(checkout):
+    """ チェックアウト中のブランチ名（.git/HEAD を直接読む．detached HEAD・読めない場合はNone） """
+    git_path = os.path.join(checkout, '.git')
+    try:
+        if os.path.isfile(git_path):
+            # worktree・submodule は .git が "gitdir: <path>" のファイルになっている
+            with open(git_path) as f:
+                git_path = os.path.join(checkout, f.read().partition('gitdir:')[2].strip())
+        with open(os.path.join(git_path, 'HEAD')) as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+    return head[len('ref: refs/heads/'):] if head.startswith('ref: refs/heads/') else None
 
-def serializer(RTC,FILE):
-    print("move dir to so")
-    os.chdir('bin')
 
-    subprocess.run("pwd")
-    subprocess.run(['ls'])
-        
-    ser = './{}'.format(FILE)
-    if os.path.isfile(ser):
-        print("File exit already")
-    else:
-        ser_copy = '../rtc/{0}/build-linux/serializer/{1}'.format(RTC,FILE)
-        shutil.copy(ser_copy,ser)
+def git_local_branch_exists(checkout, branch):
+    """ チェックアウトにローカルブランチ branch があるか """
+    result = run_command(['git', '-C', checkout, 'show-ref', '--verify', '--quiet', f"refs/heads/{branch}"],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0
 
-def build(yml_path,service):
-    with open(yml_path , 'r') as yml:
-        config = yaml.safe_load(yml)
 
- ######### Build  ros package #####################
-    print("Build ROS package")
-    print("catkin build")
-    os.chdir(ros_ws)
-    
-    subprocess.run(["rosdep", "install", "-y", "-r", "--from-paths", "src", "--ignore-src"])
-    subprocess.call(["catkin", "build",f"{service}"]) 
-    print("source devel/setup.bash")
-    subprocess.call("source ~/catkin_ws/devel/setup.bash",shell=True,executable = BASH) 
+def git_checkout_command(checkout, url, branch, mirror=True):
+    """
+    既存のチェックアウトを指定のブランチに切り替えるコマンド（ミラーがあればミラーから取得する）．
+    ローカルブランチが既にある場合はそのまま切り替え，リモートの先頭に合わせ直さない（未pushのコミットを残す）．
+    """
+    source = git_mirror_path(url) if mirror else 'origin'
+    fetch = ['git', '-C', checkout, 'fetch', '--quiet', source, f"+refs/heads/{branch}:refs/remotes/origin/{branch}"]
+    if git_local_branch_exists(checkout, branch):
+        return [fetch, ['git', '-C', checkout, 'checkout', '--quiet', str(branch)]]
+    return [fetch, ['git', '-C', checkout, 'checkout', '--quiet', '-b', str(branch), '--track', f"origin/{branch}"]]
+
+
+def print_collect_plan(fetch_jobs, apt_list, pip_list, install):
+    """ --dry-run: collect で実行する内容を表示する """
+    print("------------------------- 実行計画 (--dry-run) -------------------------")
+    for job in fetch_jobs:
+        action = 'checkout' if job['kind'] == 'git' and os.path.isdir(job['dest']) else 'clone'
+        branch = f" (branch {job['branch']})" if job['branch'] is not None else ''
+        print(f"{action:8} {job['kind']:6} {job['name']}{branch}")
+    if install:
+        print(f"apt install: {' '.join(apt_list) if apt_list else '(なし)'}")
+        print(f"pip install: {' '.join(pip_list) if pip_list else '(なし)'}")
+    if not fetch_jobs and (not install or not apt_list and not pip_list):
+        print("全てのパッケージが揃っています")
+
+
+############################## apt/pipの一括インストール ##############################
+def unique_items(items):
+    """ Noneを除き，順序を保ったまま重複を除く """
+    result = []
+    for item in items:
+        if item is not None and str(item) not in result:
+            result.append(str(item))
+    return result
+
+
+def apt_install(packages):
+    """ aptでパッケージをインストールする（成功したらTrue） """
+    install = ['sudo', '-S', 'apt', '-y', 'install'] + list(packages)
+    password = "rsdlab\n".encode()
+    return call_command(install, input=password) == 0
+
+
+def pip_install(requirements):
+    """ pipでパッケージをインストールする（成功したらTrue） """
+    return call_command(['pip', 'install'] + list(requirements)) == 0
+
+
+def install_batch(kind, items, installer, batch=True):
+    """
+    全パッケージを1回のトランザクションでインストールする．
+    失敗した場合は1件ずつインストールし直して原因のパッケージを特定する．
+    失敗したパッケージのリストを返す．
+    """
+    if not items:
+        print(f"{kind} pass")
+        return []
+
+    if batch:
+        print(f"{kind} install: {' '.join(items)}")
+        if installer(items):
+            return []
+        print(f"{kind}の一括インストールに失敗しました．1件ずつインストールします")
+
+    failed = []
+    for item in items:
+        print(item)
+        if not installer([item]):
+            failed.append(item)
+
+    for item in failed:
+        print(f"[NG] {kind} {item}")
+    return failed
+
+
+@traced
+def install_packages(apt_list, pip_list, batch=True, bundle_dir=None):
+    """ apt → pip の順にまとめてインストールする（bundle_dir がある場合はバンドルからインストールする） """
+    if bundle_dir is not None:
+        failed = install_batch('apt', apt_list, functools.partial(apt_install_bundle, bundle_dir), batch)
+        failed += install_batch('pip', pip_list, functools.partial(pip_install_bundle, bundle_dir), batch)
+        return failed
+
+    failed = install_batch('apt', apt_list, apt_install, batch)
+    failed += install_batch('pip', pip_list, pip_install, batch)
+    return failed
+
+
+############################## オフライン用のバンドル ##############################
+# バンドルの構成: wheels/ (pipのwheel), debs/ (aptの.deb), bundle.json (パッケージ → 必要な.deb)
+def bundle_manifest_path(bundle_dir):
+    return os.path.join(bundle_dir, 'bundle.json')
+
+
+def apt_dependency_closure(package):
+    """ aptパッケージとその依存先(Depends/PreDepends)のパッケージ名の一覧 """
+    result = run_command(['apt-cache', 'depends', '--recurse', '--no-recommends', '--no-suggests',
+                          '--no-conflicts', '--no-breaks', '--no-replaces', '--no-enhances', str(package)],
+                         capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    # 字下げの無い行がパッケージ名（<...> は仮想パッケージ）
+    return unique_items(line.strip() for line in result.stdout.splitlines()
+                        if line and not line[0].isspace() and not line.startswith('<'))
 
- ######### Build rtm package #####################
-    leng_rtm = config['collect']['rtm']
-    length_rtm = len(leng_rtm)
-    for i in range(length_rtm):
-        was_rep1 = config['collect']['rtm'][i]
-        dir_name = f"{rtm_ws}/{was_rep1}" 
-        os.chdir(dir_name)
-        print('Package build {}'.format(was_rep1))
-        call(['./mgr.py', 'rtc', 'build', 'all','-v'])
-        
 
-######### Start name server ##################### 
-def nameserver():
-    result = subprocess.run(["ps", "aux"], capture_output=True, text=True)
-    matching_lines = [line for line in result.stdout.splitlines() if "rosmaster" in line and "grep" not in line]
-    if not len(matching_lines) > 0:
-        print("roscoreが起動していません。roscoreを起動します...")
-        call(["gnome-terminal", "--", "roscore"])
+def find_deb(deb_dir, name):
+    """ debs/ 内のパッケージ name の.debファイル名（無ければNone） """
+    files = sorted(glob.glob(os.path.join(deb_dir, f"{name.split(':')[0]}_*.deb")))
+    return os.path.basename(files[-1]) if files else None
 
-        time.sleep(0.5)
 
-    else:
-        print("roscoreはすでに起動しています．")
+def bundle_apt(apt_list, deb_dir):
+    """ aptパッケージを依存先も含めてダウンロードし，パッケージ → [(名前, .deb)] を返す """
+    closures = {}
+    for package in apt_list:
+        closure = apt_dependency_closure(package)
+        if closure is None:
+            print(f"[NG] apt {package} の依存関係を取得できません")
+        else:
+            closures[package] = closure
+
+    missing = unique_items(name for closure in closures.values() for name in closure if find_deb(deb_dir, name) is None)
+    if missing:
+        print(f"apt download: {len(missing)}件")
+        if call_command(['apt-get', 'download'] + missing, cwd=deb_dir) != 0:
+            for name in missing:
+                call_command(['apt-get', 'download', name], cwd=deb_dir)
+
+    bundled = {}
+    for package, closure in closures.items():
+        debs = [(name, find_deb(deb_dir, name)) for name in closure]
+        lacking = [name for name, deb in debs if deb is None]
+        if lacking:
+            print(f"[NG] apt {package} ダウンロードできないパッケージがあります: {lacking}")
+        else:
+            bundled[package] = debs
+    return bundled
 
-    result = subprocess.run(["ps", "aux"], capture_output=True, text=True)
-    matching_lines = [line for line in result.stdout.splitlines() if "omni" in line and "grep" not in line]
-    print(len(matching_lines))
 
-    if not len(matching_lines) > 0:
-        print("nameserverが起動していません。namaserverを起動します...")
-        result = subprocess.run(["locale"], capture_output=True, text=True)
-        matching_lines = [line for line in result.stdout.splitlines() if "en" in line]
+def bundle_pip(pip_list, wheel_dir):
+    """ pipパッケージを依存先も含めてwheelにし，wheel_dir に保存できた要求の一覧を返す """
+    command = ['pip', 'wheel', '--wheel-dir', wheel_dir, '--find-links', wheel_dir]
+    if call_command(command + pip_list) == 0:
+        return list(pip_list)
 
-        username = os.environ['USER']
-        child = pexpect.spawn("wasanbon-admin.py nameserver start", encoding='utf-8')
-        if not len(matching_lines) > 0:
-            child.expect(f"{username} のパスワード:")
+    print("pip wheel の一括作成に失敗しました．1件ずつ作成します")
+    bundled = []
+    for requirement in pip_list:
+        if call_command(command + [requirement]) == 0:
+            bundled.append(requirement)
         else:
-            child.expect(f"password for {username}:")
+            print(f"[NG] pip {requirement}")
+    return bundled
 
-        child.sendline(username)
-        child.interact()
 
-    else:
-        print("nameserverはすでに起動しています．")
+@traced
+def create_bundle(apt_list, pip_list, bundle_dir):
+    """
+    apt/pipのパッケージを依存先も含めて bundle_dir に保存する．
+    既存のバンドルに追記するので，複数のロボットで1つのバンドルを共有できる．
+    """
+    deb_dir = os.path.join(bundle_dir, 'debs')
+    wheel_dir = os.path.join(bundle_dir, 'wheels')
+    os.makedirs(deb_dir, exist_ok=True)
+    os.makedirs(wheel_dir, exist_ok=True)
+
+    manifest = load_json(bundle_manifest_path(bundle_dir))
+    manifest.setdefault('apt', {})
+    manifest.setdefault('pip', [])
+
+    print(f"aptの個数: {len(apt_list)}")
+    manifest['apt'].update(bundle_apt(apt_list, deb_dir))
+    print(f"pipの個数: {len(pip_list)}")
+    if pip_list:
+        manifest['pip'] = unique_items(manifest['pip'] + bundle_pip(pip_list, wheel_dir))
+
+    save_json(bundle_manifest_path(bundle_dir), manifest)
+    lacking = [item for item in apt_list if item not in manifest['apt']]
+    lacking += [item for item in pip_list if item not in manifest['pip']]
+    print(f"バンドルを作成しました: {bundle_dir}（失敗: {lacking}）")
+    return lacking
+
+
+def installed_apt_packages():
+    """ インストール済みのaptパッケージ名 """
+    return {name.split(':')[0] for name in installed_packages('apt')}
+
+
+def apt_install_bundle(bundle_dir, packages):
+    """ バンドルの.debからaptパッケージをインストールする（インデックスにはアクセスしない） """
+    bundled = load_json(bundle_manifest_path(bundle_dir)).get('apt', {})
+    lacking = [package for package in packages if package not in bundled]
+    if lacking:
+        print(f"バンドルにありません: {lacking}")
+        return False
+
+    # インストール済みのパッケージは古い版に置き換えないよう対象から外す
+    installed = installed_apt_packages()
+    debs = unique_items(os.path.join(bundle_dir, 'debs', deb) for package in packages
+                        for name, deb in bundled[package] if name.split(':')[0] not in installed)
+    if not debs:
+        return True
+    install = ['sudo', '-S', 'apt-get', '-y', '--no-download', 'install'] + debs
+    password = "rsdlab\n".encode()
+    return call_command(install, input=password) == 0
+
+
+def pip_install_bundle(bundle_dir, requirements):
+    """ バンドルのwheelからpipパッケージをインストールする（インデックスにはアクセスしない） """
+    wheel_dir = os.path.join(bundle_dir, 'wheels')
+    return call_command(['pip', 'install', '--no-index', '--find-links', wheel_dir] + list(requirements)) == 0
+
+
+@traced
+def collect(collect_config, jobs=FETCH_WORKERS, install=True, pending=([], []), batch=True,
+            mirror=True, depth=None, filter_spec=None, offline=False, bundle_dir=None, reconcile=True, dry_run=False):
+    """
+    ロボットファイル(またはcollect用yaml)のcollectセクション(CollectConfig)に記載されたパッケージを取得する．
+    install=False の場合は apt/pip をインストールせず (apt, pip) のリストを返すので，
+    次の collect の pending に渡すと1回のトランザクションでまとめてインストールできる．
+    gitリポジトリは mirror=True の場合，ミラー(git_mirror_dir)を経由して clone する．
+    bundle_dir を指定した場合，apt/pip は create_bundle で作成したバンドルからインストールする．
+    reconcile=True の場合はインストール済みのapt/pip・指定のブランチをチェックアウト済みのリポジトリを除き，
+    dry_run=True の場合は実行する内容を表示するだけにする．
+    """
+    if collect_config is None:
+        collect_config = CollectConfig()
 
-def run(yml_path = None):
-    processes = {}
+    fetch_jobs = []
+    results = []
 
-    print(yml_path)
+ ######### wasanbon repository #####################    
+    leng_rtm = collect_config.rtm
+    length_rtm = len(leng_rtm)
+    print(f"wasanbonパッケージの個数: {length_rtm}")
 
-    if yml_path is None:
-        with open(args[1] , 'r') as yml:
-            config = yaml.safe_load(yml)
-    else:
-        with open(yml_path , 'r') as yml:
-            config = yaml.safe_load(yml)
+    for was_rep1 in leng_rtm:
+        ser_rtm = os.path.join(rtm_ws, str(was_rep1))
+        if os.path.isdir(ser_rtm):
+            print(f"rtm File exit already: {was_rep1}")
+            results.append({'job': fetch_job('rtm', was_rep1, [], rtm_ws, ser_rtm),
+                            'status': 'SKIP', 'error': None, 'elapsed': 0.0})
+        else:
+            command = ['wasanbon-admin.py', 'repository', 'clone', str(was_rep1), '-v']
+            fetch_jobs.append(fetch_job('rtm', was_rep1, command, rtm_ws, ser_rtm))
 
-    print("roslaunch")
+ ######### engine repository #####################    
+    path_ros = ros_ws + "/src/"
+    leng_engine = collect_config.engine
+    print(f"hri engineパッケージの個数: {len(leng_engine)}")
+
+    for was_rep1 in leng_engine:
+        ser_engine = os.path.join(path_ros, str(was_rep1))
+        if os.path.isdir(ser_engine):
+            print(f"engine File exit already: {was_rep1}")
+            results.append({'job': fetch_job('engine', was_rep1, [], path_ros, ser_engine),
+                            'status': 'SKIP', 'error': None, 'elapsed': 0.0})
+        else:
+            command = ['wasanbon-admin.py', 'repository', 'clone', str(was_rep1), '-v']
+            fetch_jobs.append(fetch_job('engine', was_rep1, command, path_ros, ser_engine))
 
-    if 'roslaunch' in config['run']:
-        leng_launch = config['run']['roslaunch']
-    else:
-        print("No ROS_LAUNCH module")
-        return None
+ ######### ros package #####################
+    print(f"repoの個数: {len(collect_config.git)}")
+
+    for item in collect_config.git:
+        url, repo, branch = item.url, item.repo, item.branch
+        print(f"repository name :{repo}")
+
+        ser_git = f'{ros_ws}/src/'+ str(repo)
+        if os.path.isdir(ser_git) and branch is not None and git_head_branch(ser_git) != str(branch):
+            # 指定と異なるブランチがチェックアウトされている場合はブランチだけ切り替える
+            print(f"repository exit already: {git_head_branch(ser_git)} → {branch}")
+            command = git_checkout_command(ser_git, url, branch, mirror)
+            fetch_jobs.append(fetch_job('git', repo, command, path_ros, ser_git, branch,
+                                        url if mirror else None, offline))
+        elif os.path.isdir(ser_git):
+            print("repository exit already")
+            results.append({'job': fetch_job('git', repo, [], path_ros, ser_git, branch),
+                            'status': 'SKIP', 'error': None, 'elapsed': 0.0})
+        else:
+            command = git_clone_command(url, repo, branch, mirror, depth, filter_spec)
+            fetch_jobs.append(fetch_job('git', repo, command, path_ros, ser_git, branch,
+                                        url if mirror else None, offline))
+
+    apt_list = unique_items(collect_config.apt + pending[0])
+    pip_list = unique_items(collect_config.pip + pending[1])
+    if dry_run:
+        if install and reconcile:
+            apt_list, pip_list = reconcile_packages(apt_list, pip_list)
+        print_collect_plan(fetch_jobs, apt_list, pip_list, install)
+        return (apt_list, pip_list) if not install else None
+
+    # clone はworker数を上限に並列実行し，その間に apt/pip のインストールを進める．
+    # wasanbon は clone したパッケージを ~/.wasanbon/workspace.yaml に登録するため，
+    # 同時に実行すると登録が失われる．wasanbon の clone は1つずつ実行し，git の clone だけを並列にする
+    wasanbon_jobs = [job for job in fetch_jobs if job['kind'] in ('rtm', 'engine')]
+    git_jobs = [job for job in fetch_jobs if job['kind'] not in ('rtm', 'engine')]
+    git_workers = max(1, int(jobs) - 1) if wasanbon_jobs else max(1, int(jobs))
+    with ThreadPoolExecutor(max_workers=git_workers) as executor, \
+            ThreadPoolExecutor(max_workers=1) as wasanbon_executor:
+        futures = [wasanbon_executor.submit(run_fetch_job, job) for job in wasanbon_jobs]
+        futures += [executor.submit(run_fetch_job, job) for job in git_jobs]
+
+ ######### apt / pip repository #####################
+        print(f"aptの個数: {len(apt_list)}")
+        print(f"pipの個数: {len(pip_list)}")
+
+        if install:
+            if reconcile:
+                apt_list, pip_list = reconcile_packages(apt_list, pip_list)
+            install_packages(apt_list, pip_list, batch, bundle_dir)
+            invalidate_installed()
+
+        for future in as_completed(futures):
+            result = future.result()
+            print(f"{result['job']['name']}: {result['status']}")
+            results.append(result)
+
+    print_fetch_summary(results)
+
+    if not install:
+        return apt_list, pip_list
+    post_collect_hooks(leng_rtm)
+
+
+####################  Add  edit  modules(by editor) #####################
+# rtm の先頭のパッケージ → collect の後に実行する処理（関数はこのファイルには含まれていない）
+POST_COLLECT_HOOKS = {
+    'Destination_gui': ("move system file", 'move_file'),
+    'MobileRobotControl': ("install sfml", 'sfml'),
+}
+
+
+def post_collect_hooks(rtm):
+    """
+    rtm の先頭のパッケージに応じた後処理を行う．
+    install=False の collect では実行されないため，まとめてインストールした後にロボットファイルの rtm でも呼ぶ．
+    """
+    if not rtm:
+        print("rtm pass")
+        return
+    message, name = POST_COLLECT_HOOKS.get(str(rtm[0]), (None, None))
+    if name is None:
+        print("move file for navigation")
+        print("not install sfml")
+        return
+    print(message)
+    hook = globals().get(name)
+    if hook is None:
+        print(f"{name}() が定義されていないため {rtm[0]} の後処理を実行できません")
+        return
+    hook()
 
-    if leng_launch is None:
-        pass
+
+def serializer(RTC,FILE, package_dir='.'):
+    # 作業ディレクトリ(os.chdir)は変えずにパッケージのディレクトリからのパスで扱う
+    print("move dir to so")
+    bin_dir = os.path.join(package_dir, 'bin')
+    print(os.listdir(bin_dir))
+        
+    ser = os.path.join(bin_dir, FILE)
+    if os.path.isfile(ser):
+        print("File exit already")
     else:
-        for index, launch_cmd in enumerate(leng_launch):
+        ser_copy = os.path.join(package_dir, 'rtc', RTC, 'build-linux', 'serializer', FILE)
+        shutil.copy(ser_copy,ser)
+
+############################## ビルドの差分判定 ##############################
+# ハッシュ計算から除外するディレクトリ（ビルド生成物など）
+HASH_EXCLUDE_DIRS = ['.git', '.catkin_tools', '__pycache__', 'build', 'devel', 'logs', 'build-linux', 'bin', 'log']
+
+
+def hash_file(file_path, stat_cache=None):
+    """
+    ファイル内容のハッシュ値を計算する．
+    stat_cacheを渡すと，サイズと更新時刻が変わっていないファイルは前回の値を使う．
+    """
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return '-'
+
+    signature = [stat.st_size, stat.st_mtime_ns]
+    if stat_cache is not None:
+        cached = stat_cache.get(file_path)
+        if cached and cached[:2] == signature:
+            return cached[2]
+
+    digest = hashlib.sha1()
+    try:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    except OSError:
+        return '-'
+
+    if stat_cache is not None:
+        stat_cache[file_path] = signature + [digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def hash_tree(path, stat_cache=None):
+    """ ディレクトリ以下のソース(ファイル名と内容)からハッシュ値を計算する """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in HASH_EXCLUDE_DIRS)
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            digest.update(hash_file(file_path, stat_cache).encode())
+    return digest.hexdigest()
+
+
+def hash_config(data):
+    """ yamlの内容(辞書)からハッシュ値を計算する """
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def find_ros_packages(src_dir):
+    """ src以下のROSパッケージ(package.xmlのあるディレクトリ)を探し，パッケージ名 → パスを返す """
+    packages = {}
+    for root, dirs, files in os.walk(src_dir):
+        if 'CATKIN_IGNORE' in files:
+            dirs[:] = []
+            continue
+        if 'package.xml' in files:
             try:
-                proc = subprocess.Popen(["gnome-terminal", "--tab", "--", "bash", "-c", f"roslaunch {launch_cmd}"])
-                processes[f"roslaunch_{index}"] = proc.pid  
+                name = ET.parse(os.path.join(root, 'package.xml')).getroot().findtext('name')
+            except ET.ParseError:
+                name = None
+            packages[(name or os.path.basename(root)).strip()] = root
+            dirs[:] = []
+            continue
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d not in HASH_EXCLUDE_DIRS)
+    return packages
 
-            except OSError as e:
-                print(f"Failed to start roslaunch process {launch_cmd}: {e}")
-                continue  
 
-    print("rosrun")
+def changed_units(previous, current):
+    """ 前回のビルドからハッシュ値が変わった(追加・削除を含む)ものの名前を返す """
+    return sorted(name for name in set(previous) | set(current) if previous.get(name) != current.get(name))
 
-    if 'rosrun' in config['run']:
-        leng_run = config['run']['rosrun']
-    else:
-        print("No ROS_RUN module")
+
+############################## ビルド成果物のキャッシュ ##############################
+# catkinワークスペース・RTCパッケージのビルド成果物（ワークスペース・パッケージからの相対パス）
+ROS_ARTIFACTS = ['build', 'devel', '.catkin_tools']
+RTC_ARTIFACTS = ['bin', 'rtc/*/build-linux']
+
+
+def package_version(package_xml):
+    """ package.xml の version（読めない場合は None） """
+    try:
+        return ET.parse(package_xml).getroot().findtext('version')
+    except (OSError, ET.ParseError):
         return None
 
-    if leng_run is None:
+
+@functools.lru_cache(maxsize=None)
+def toolchain_versions():
+    """ ビルド成果物に影響するROS・OpenRTMのバージョンと実行環境 """
+    ros_distro = os.environ.get('ROS_DISTRO', '')
+    openrtm = None
+    try:
+        result = run_command(['pkg-config', '--modversion', 'openrtm-aist'], capture_output=True, text=True)
+        if result.returncode == 0:
+            openrtm = result.stdout.strip()
+    except FileNotFoundError:
         pass
+    if openrtm is None:
+        try:
+            openrtm = importlib.metadata.version('OpenRTM-aist-Python')
+        except importlib.metadata.PackageNotFoundError:
+            pass
+
+    os_release = {}
+    if os.path.exists('/etc/os-release'):
+        with open('/etc/os-release') as f:
+            for line in f:
+                key, sep, value = line.strip().partition('=')
+                if sep:
+                    os_release[key] = value.strip('"')
+
+    return {
+        'ros': f"{ros_distro} {package_version(f'/opt/ros/{ros_distro}/share/ros_environment/package.xml')}",
+        'openrtm': openrtm,
+        'os': f"{os_release.get('ID')} {os_release.get('VERSION_ID')}",
+        'machine': os.uname().machine,
+    }
+
+
+def artifact_key(kind, name, sources, robot_hash, workspace):
+    """
+    ビルド成果物のキー．ソースのハッシュ値・ロボットファイルの collect・ROS/OpenRTMのバージョンから求める．
+    生成物には絶対パスが埋め込まれるため，ワークスペースのパスも含める．
+    """
+    return hash_config({'kind': kind, 'name': name, 'sources': sources, 'robot': robot_hash,
+                        'workspace': workspace, 'toolchain': toolchain_versions()})
+
+
+def artifact_path(artifact_dir, kind, name, key):
+    return os.path.join(artifact_dir, kind, f"{name.replace('/', '__')}-{key}.tar")
+
+
+def artifact_members(base_dir, patterns):
+    """ base_dir からの相対パスのパターンに一致する既存のファイル・ディレクトリ """
+    return [os.path.relpath(path, base_dir) for pattern in patterns
+            for path in sorted(glob.glob(os.path.join(base_dir, pattern)))]
+
+
+@traced
+def restore_artifact(artifact_dir, kind, name, key, base_dir, patterns, clean=False):
+    """
+    キャッシュにビルド成果物があれば base_dir に展開する（成功したらTrue）．
+    clean=True の場合は展開する前に既存の成果物を削除する．
+    """
+    archive = artifact_path(artifact_dir, kind, name, key)
+    if not os.path.exists(archive):
+        return False
+
+    if clean:
+        for member in artifact_members(base_dir, patterns):
+            path = os.path.join(base_dir, member)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    if call_command(['tar', '-xf', archive, '-C', base_dir]) != 0:
+        print(f"{name}: キャッシュしたビルド成果物を展開できませんでした ({archive})")
+        return False
+    print(f"{name}: ビルド成果物をキャッシュから復元しました ({archive})")
+    return True
+
+
+@traced
+def store_artifact(artifact_dir, kind, name, key, base_dir, patterns):
+    """
+    ビルド成果物をキャッシュに保存する．
+    複数のロボットが同じディレクトリ(NFSなど)に保存しても壊れないよう，別名で書き込んでから置き換える．
+    """
+    archive = artifact_path(artifact_dir, kind, name, key)
+    members = artifact_members(base_dir, patterns)
+    if os.path.exists(archive) or not members:
+        return
+
+    os.makedirs(os.path.dirname(archive), exist_ok=True)
+    partial = f"{archive}.{socket.gethostname()}.{os.getpid()}.partial"
+    if call_command(['tar', '-cf', partial, '-C', base_dir, '--'] + members) != 0:
+        print(f"{name}: ビルド成果物をキャッシュに保存できませんでした")
+        if os.path.exists(partial):
+            os.remove(partial)
+        return
+    os.replace(partial, archive)
+    save_json(archive[:-len('.tar')] + '.json', {'kind': kind, 'name': name, 'workspace': base_dir,
+                                                 'host': socket.gethostname(), 'created': time.time(),
+                                                 'toolchain': toolchain_versions()})
+    print(f"{name}: ビルド成果物をキャッシュに保存しました ({archive})")
+
+
+############################## ROSパッケージの依存関係(rosdep)・実行環境 ##############################
+# package.xml の依存先のタグ（テスト用の test_depend, doc_depend は含めない）
+ROS_DEPEND_TAGS = ['depend', 'build_depend', 'buildtool_depend', 'build_export_depend', 'exec_depend', 'run_depend']
+
+
+def read_package_dependencies(package_dir):
+    """ package.xml に書かれた依存先（パッケージ名・rosdepキー） """
+    try:
+        root = ET.parse(os.path.join(package_dir, 'package.xml')).getroot()
+    except (OSError, ET.ParseError):
+        return []
+    return unique_items(element.text.strip() for tag in ROS_DEPEND_TAGS for element in root.findall(tag)
+                        if element.text and element.text.strip())
+
+
+def robot_ros_packages(robot, service, packages):
+    """
+    ロボットファイルが参照するROSパッケージ名．
+    HRI engine・gitリポジトリに含まれるパッケージと，runセクションの roslaunch/rosrun のパッケージ．
+    """
+    src_dir = os.path.join(ros_ws, 'src')
+    names = []
+    directories = [str(repository.repo) for repository in robot.collect.git]
+    if service not in (None, 'None'):
+        names.append(str(service))
+        directories.append(str(service))
+    for directory in directories:
+        repo_dir = os.path.join(src_dir, directory)
+        names += [name for name, path in packages.items() if path == repo_dir or path.startswith(repo_dir + os.sep)]
+    for kind in ('roslaunch', 'rosrun'):
+        for entry in getattr(robot.run, kind):
+            cmd = (entry.get('cmd') or entry.get('name')) if isinstance(entry, dict) else entry
+            names += str(cmd).split()[:1]
+    return unique_items(names)
+
+
+def package_closure(packages, roots):
+    """
+    roots とそれが(推移的に)依存するワークスペース内のパッケージを求める．
+
+    Returns:
+        tuple: (パッケージ名 → パス, ワークスペース外の依存先(rosdepキー)のリスト)
+    """
+    closure = {}
+    external = []
+    pending = list(roots)
+    while pending:
+        name = pending.pop()
+        if name in closure or name in external:
+            continue
+        if name not in packages:
+            external.append(name)
+            continue
+        closure[name] = packages[name]
+        pending += read_package_dependencies(packages[name])
+    return closure, sorted(external)
+
+
+def rosdep_sources_signature():
+    """ rosdep update で更新されるソースのキャッシュの更新時刻（解決結果のキャッシュの有効性の判定用） """
+    ros_home = os.environ.get('ROS_HOME', os.path.join(home_path, '.ros'))
+    try:
+        return os.stat(os.path.join(ros_home, 'rosdep', 'sources.cache')).st_mtime_ns
+    except OSError:
+        return None
+
+
+@traced
+def resolve_rosdep_keys(keys):
+    """
+    rosdepキーをインストールするパッケージに解決する（rosdep resolve）．
+    結果は rosdep update されるまでキャッシュし，まだ解決していないキーだけを1回の rosdep resolve で照会する．
+
+    Returns:
+        dict: rosdepキー → {'installer': 'apt' など, 'packages': [...]}（解決できなかったキーは installer が None）
+    """
+    cache_path = os.path.join(cache_dir, 'rosdep_resolve.json')
+    cache = load_json(cache_path)
+    signature = [os.environ.get('ROS_DISTRO'), rosdep_sources_signature()]
+    entries = cache.get('entries', {}) if cache.get('signature') == signature else {}
+    now = time.time()
+    missing = [key for key in keys if key not in entries or now - entries[key].get('time', 0) > LOOKUP_CACHE_TTL]
+
+    if missing:
+        try:
+            result = run_command(['rosdep', 'resolve'] + missing, capture_output=True, text=True)
+        except FileNotFoundError:
+            print("rosdep が見つかりません")
+            return {key: entries[key] for key in keys if key in entries}
+
+        # キーが複数の場合は "#ROSDEP[キー]" → "#インストーラ" → パッケージ名 の順に出力される
+        resolved = {}
+        current, installer = missing[0], None
+        for line in result.stdout.splitlines():
+            match = re.match(r'^#ROSDEP\[(.+)\]$', line.strip())
+            if match:
+                current, installer = match.group(1), None
+            elif line.startswith('#'):
+                installer = line[1:].strip()
+            elif line.strip() and installer:
+                resolved[current] = {'installer': installer, 'packages': line.split()}
+        for key in missing:
+            entries[key] = dict(resolved.get(key, {'installer': None, 'packages': []}), time=now)
+        save_json(cache_path, {'signature': signature, 'entries': entries})
+
+    unresolved = [key for key in keys if entries[key]['installer'] is None]
+    if unresolved:
+        print(f"rosdepで解決できない依存先: {unresolved}")
+    return {key: entries[key] for key in keys}
+
+
+@traced
+def rosdep_install(keys):
+    """ rosdepキーを解決し，インストールされていないシステムの依存パッケージ(apt/pip)だけをインストールする """
+    resolved = resolve_rosdep_keys(keys)
+    apt_list = unique_items(package for item in resolved.values() if item['installer'] == 'apt'
+                            for package in item['packages'])
+    pip_list = unique_items(package for item in resolved.values() if item['installer'] == 'pip'
+                            for package in item['packages'])
+    others = [key for key, item in resolved.items() if item['installer'] not in ('apt', 'pip', None)]
+    if others:
+        print(f"apt/pip 以外でインストールする依存先はスキップします: {others}")
+
+    apt_missing, pip_missing = reconcile_packages(apt_list, pip_list)
+    if apt_missing or pip_missing:
+        failed = install_packages(apt_missing, pip_missing)
+        invalidate_installed()
+        if failed:
+            print(f"インストールに失敗した依存パッケージ: {failed}")
+
+
+# devel/setup.bash を読み込んだ環境変数（ros_environment() で1回だけ作る）
+ros_environment_cache = {}
+ros_environment_lock = threading.Lock()
+
+
+def ros_environment():
+    """
+    ワークスペースの devel/setup.bash を読み込んだ後の環境変数．
+    起動するコンポーネントごとに読み込まず，最初に1回だけ bash で読み込んだ結果を使う．
+    """
+    with ros_environment_lock:
+        if 'env' not in ros_environment_cache:
+            env = dict(os.environ)
+            setup = os.path.join(ros_ws, 'devel', 'setup.bash')
+            if os.path.exists(setup):
+                result = run_command([BASH, '-c', 'source "$1" > /dev/null && env -0', BASH, setup],
+                                     capture_output=True)
+                if result.returncode == 0:
+                    env = dict(item.split('=', 1) for item in result.stdout.decode('utf-8', 'replace').split('\0')
+                               if '=' in item)
+                else:
+                    print(f"{setup} を読み込めませんでした")
+            ros_environment_cache['env'] = env
+        return ros_environment_cache['env']
+
+
+def invalidate_ros_environment():
+    """ ビルドで devel/setup.bash が変わった場合に，次回 ros_environment() で読み込み直す """
+    with ros_environment_lock:
+        ros_environment_cache.clear()
+
+
+############################## RTCパッケージの並列ビルド ##############################
+def read_rtc_dependencies(package_dir):
+    """
+    wasanbonパッケージのメタデータから依存するパッケージ名を読む．
+    setting.yaml の application.depends と，rtc/repository.yaml の各RTCの depends を参照する．
+    """
+    depends = []
+
+    setting_path = os.path.join(package_dir, 'setting.yaml')
+    if os.path.exists(setting_path):
+        setting = load_yaml(setting_path) or {}
+        depends.extend((setting.get('application') or {}).get('depends') or [])
+
+    repository_path = os.path.join(package_dir, 'rtc', 'repository.yaml')
+    if os.path.exists(repository_path):
+        for info in (load_yaml(repository_path) or {}).values():
+            if isinstance(info, dict):
+                depends.extend(info.get('depends') or [])
+
+    return unique_items(depends)
+
+
+def run_rtc_build(name, package_dir, log_path, env):
+    """ RTCパッケージを1つビルドし，出力をログファイルに保存する """
+    print(f"Package build {name} (log: {log_path})")
+    start = time.monotonic()
+    with open(log_path, 'w') as log:
+        returncode = call_command(['./mgr.py', 'rtc', 'build', 'all', '-v'], cwd=package_dir,
+                                  stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, env=env)
+    print(f"Package build {name}: 終了コード {returncode} ({time.monotonic() - start:.1f}s)")
+    return returncode
+
+
+@traced
+def build_rtc_packages(packages, workers, make_jobs):
+    """
+    RTCパッケージを依存関係の順に，独立したものは並列にビルドする．
+
+    Args:
+        packages (dict): パッケージ名 → ディレクトリ
+        workers (int): 同時にビルドするパッケージ数
+        make_jobs (int): 各ビルドのmakeの並列数
+
+    Returns:
+        dict: パッケージ名 → 'OK' / 'NG' / 'SKIP'（依存先のビルドに失敗）
+    """
+    depends = {name: [dep for dep in read_rtc_dependencies(path) if dep in packages and dep != name]
+               for name, path in packages.items()}
+    log_dir = os.path.join(cache_dir, 'log', 'build')
+    os.makedirs(log_dir, exist_ok=True)
+    env = dict(os.environ, MAKEFLAGS=f"-j{make_jobs}")
+
+    status = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while len(status) < len(packages):
+            waiting = [name for name in packages if name not in status and name not in running.values()]
+            for name in waiting:
+                if any(status.get(dep) in ('NG', 'SKIP') for dep in depends[name]):
+                    print(f"{name}: 依存するパッケージのビルドに失敗したためスキップします")
+                    status[name] = 'SKIP'
+
+            for name in waiting:
+                if name not in status and all(status.get(dep) == 'OK' for dep in depends[name]):
+                    log_path = os.path.join(log_dir, f"{name}.log")
+                    running[executor.submit(run_rtc_build, name, packages[name], log_path, env)] = name
+
+            if not running:
+                for name in packages:
+                    if name not in status:
+                        print(f"{name}: 依存関係が循環しているためビルドできません {depends[name]}")
+                        status[name] = 'NG'
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                status[name] = 'OK' if future.result() == 0 else 'NG'
+
+    return status
+
+
+def split_build_jobs(total_jobs, rtc_count, build_ros):
+    """
+    並列数 total_jobs を catkin と RTC のビルドに配分する．
+    RTC は rtc_workers 個を同時に make -j{make_jobs} でビルドするため，
+    catkin_jobs + rtc_workers * make_jobs が total_jobs を超えないようにする．
+
+    Returns:
+        tuple: (catkin_jobs, rtc_workers, make_jobs, concurrent)
+               concurrent が False の場合は配分できないため，catkin と RTC のビルドを順に行う
+    """
+    if not rtc_count or not build_ros:
+        rtc_workers = max(1, min(rtc_count, total_jobs))
+        return total_jobs, rtc_workers, max(1, total_jobs // rtc_workers), True
+    rtc_budget = max(1, total_jobs // 2)
+    rtc_workers = min(rtc_count, rtc_budget)
+    make_jobs = rtc_budget // rtc_workers
+    catkin_jobs = max(1, total_jobs - rtc_workers * make_jobs)
+    if catkin_jobs + rtc_workers * make_jobs > total_jobs:
+        # total_jobs が1の場合など．同時に実行すると jobs を超えるため順に実行する
+        return total_jobs, min(rtc_count, total_jobs), 1, False
+    return catkin_jobs, rtc_workers, make_jobs, True
+
+
+@traced
+def build_ros_packages(packages, rosdep_keys, rosdep, catkin_jobs):
+    """ ROSパッケージ(packages)が依存するシステムのパッケージをインストールし，catkin build を実行する（成功したらTrue） """
+    if rosdep:
+        rosdep_install(rosdep_keys)
     else:
-        for index, run_cmd in enumerate(leng_run):
-            try:
-                proc = subprocess.Popen(["gnome-terminal", "--tab", "--", "bash", "-c", f"rosrun {run_cmd}"])
-                processes[f"rosrun_{index}"] = proc.pid  
+        print("package.xmlに変更がないため rosdep の依存パッケージのインストールをスキップします")
 
-            except OSError as e:
-                print(f"Failed to start rosrun process {run_cmd}: {e}")
-                continue  
-    
-    print("launch rtm packages")
+    print(f"catkin build {sorted(packages)}")
+    returncode = call_command(["catkin", "build", f"-j{catkin_jobs}"] + sorted(packages), cwd=ros_ws)
+    # 以降に起動するコンポーネントはビルド後の devel/setup.bash を読み込んだ環境で起動する
+    invalidate_ros_environment()
+    return returncode == 0
 
-    if 'rtm' in config['run']:
-        leng_rtm = config['run']['rtm']
+
+@traced
+def build(robot, service, force=False, jobs=None, artifact_dir=None):
+    """
+    変更のあったROSパッケージ・RTCパッケージをビルドする．
+    artifact_dir を指定した場合，同じソース・設定のビルド成果物があればビルドせずに復元し，
+    ビルドした成果物はそこに保存する（force=True の場合は復元せずにビルドする）．
+    """
+
+    # 前回ビルドした時点のソース・ロボットファイル(collect)のハッシュ値
+    manifest_path = os.path.join(cache_dir, 'build_manifest.json')
+    manifest = load_json(manifest_path)
+    stat_cache = load_json(os.path.join(cache_dir, 'hash_cache.json'))
+    robot_hash = hash_config(asdict(robot.collect))
+
+ ######### Check  ros package #####################
+    ros_key = f"ros:{ros_ws}:{service}"
+    previous = manifest.get(ros_key, {})
+    # ロボットファイルが参照するパッケージとその依存先だけを rosdep・catkin の対象にする
+    workspace_packages = find_ros_packages(os.path.join(ros_ws, "src"))
+    packages, rosdep_keys = package_closure(workspace_packages, robot_ros_packages(robot, service, workspace_packages))
+    package_hashes = {name: hash_tree(path, stat_cache) for name, path in packages.items()}
+    xml_hashes = {name: hash_file(os.path.join(path, 'package.xml')) for name, path in packages.items()}
+
+    changed = changed_units(previous.get('packages', {}), package_hashes)
+    build_ros = bool(packages) and (force or bool(changed) or previous.get('robot') != robot_hash)
+    if not packages:
+        print("ビルドするROSパッケージがありません")
+    elif build_ros:
+        print(f"変更のあったROSパッケージ: {changed}")
     else:
-        print("No RTM module")
-        return None
+        print("ROSパッケージに変更がないため catkin build をスキップします")
+
+ ######### Check rtm package #####################
+    rtc_packages = {}
+    rtc_hashes = {}
+    for was_rep1 in robot.collect.rtm:
+        dir_name = f"{rtm_ws}/{was_rep1}" 
+        rtm_previous = manifest.get(f"rtm:{dir_name}", {})
+        rtc_hashes[was_rep1] = hash_tree(dir_name, stat_cache)
+        if not force and rtm_previous.get('source') == rtc_hashes[was_rep1] and rtm_previous.get('robot') == robot_hash:
+            print(f"{was_rep1} に変更がないためビルドをスキップします")
+        else:
+            rtc_packages[was_rep1] = dir_name
+
+ ######### Restore build artifacts #####################
+    # 他のマシン・ワークスペースで同じ条件でビルドした成果物があれば，ビルドせずに復元する
+    if artifact_dir:
+        ros_artifact = artifact_key('ros', service, package_hashes, robot_hash, ros_ws)
+        if build_ros and not force and restore_artifact(artifact_dir, 'ros', service, ros_artifact, ros_ws,
+                                                        ROS_ARTIFACTS, clean=True):
+            # 実行時に必要なシステムの依存パッケージはこのマシンにインストールする
+            if changed_units(previous.get('package_xml', {}), xml_hashes):
+                rosdep_install(rosdep_keys)
+            invalidate_ros_environment()
+            manifest[ros_key] = {'robot': robot_hash, 'packages': package_hashes, 'package_xml': xml_hashes}
+            build_ros = False
+
+        rtc_artifacts = {}
+        for name, dir_name in list(rtc_packages.items()):
+            # 依存するパッケージのソースが変わった場合も作り直す
+            sources = {dep: rtc_hashes.get(dep) or hash_tree(f"{rtm_ws}/{dep}", stat_cache)
+                       for dep in [name] + read_rtc_dependencies(dir_name)}
+            rtc_artifacts[name] = artifact_key('rtm', name, sources, robot_hash, dir_name)
+            if not force and restore_artifact(artifact_dir, 'rtm', name, rtc_artifacts[name], dir_name, RTC_ARTIFACTS):
+                manifest[f"rtm:{dir_name}"] = {'robot': robot_hash, 'source': hash_tree(dir_name, stat_cache)}
+                del rtc_packages[name]
+
+ ######### Build ros / rtm package #####################
+    # catkin と RTC のビルドを同時に行い，全体の並列数が jobs を超えないように配分する
+    total_jobs = max(1, int(jobs or os.cpu_count() or 1))
+    catkin_jobs, rtc_workers, make_jobs, concurrent = split_build_jobs(total_jobs, len(rtc_packages), build_ros)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if build_ros:
+            print("Build ROS package")
+            rosdep = force or bool(changed_units(previous.get('package_xml', {}), xml_hashes))
+            ros_future = executor.submit(build_ros_packages, packages, rosdep_keys, rosdep, catkin_jobs)
+            if not concurrent:
+                wait([ros_future])
+
+        rtc_status = build_rtc_packages(rtc_packages, rtc_workers, make_jobs) if rtc_packages else {}
+
+        if build_ros and ros_future.result():
+            manifest[ros_key] = {'robot': robot_hash, 'packages': package_hashes, 'package_xml': xml_hashes}
+            if artifact_dir:
+                store_artifact(artifact_dir, 'ros', service, ros_artifact, ros_ws, ROS_ARTIFACTS)
+
+    for name, result in rtc_status.items():
+        print(f"[{result:4}] {name}")
+        if result == 'OK':
+            # ビルド時に生成されるファイルも含めて記録する
+            dir_name = rtc_packages[name]
+            manifest[f"rtm:{dir_name}"] = {'robot': robot_hash, 'source': hash_tree(dir_name, stat_cache)}
+            if artifact_dir:
+                store_artifact(artifact_dir, 'rtm', name, rtc_artifacts[name], dir_name, RTC_ARTIFACTS)
+
+    save_json(manifest_path, manifest)
+    save_json(os.path.join(cache_dir, 'hash_cache.json'), stat_cache)
+
+
+############################## コンポーネントのログ収集 ##############################
+class RotatingLog:
+    """ 1行ずつ追記し，max_bytes を超えたら <path>.1, <path>.2 ... にずらして新しいファイルに書き込む """
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+
+    def write(self, data):
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class LogPipeline:
+    """
+    起動したコンポーネントの stdout/stderr をパイプで受け取り，1行ごとにコンポーネント名・時刻を付けて
+    メモリ上のリングバッファとコンポーネントごとのログファイル(JSON Lines，サイズでローテーション)に保存する．
+    パイプは専用スレッドの asyncio で読み続け，ファイルへの書き込みは別スレッドで行うため，
+    ディスクが遅い場合も出力の多いコンポーネントを待たせない（書き込みが追いつかない行は破棄する）．
+    """
 
-    if leng_rtm is None:
+    def __init__(self, buffer_lines=LOG_BUFFER_LINES, queue_chunks=LOG_QUEUE_CHUNKS):
+        self.buffer_lines = buffer_lines
+        self.buffers = {}
+        self.dropped = {}
+        self.readers = set()
+        self.queue = queue.Queue(maxsize=queue_chunks)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.writer = threading.Thread(target=self.write_lines, daemon=True)
+        self.writer.start()
+
+    def attach(self, name, log_path, pipe, stream):
+        """ コンポーネントの出力(pipe)の読み込みを開始する """
+        self.buffers.setdefault(name, collections.deque(maxlen=self.buffer_lines))
+        future = asyncio.run_coroutine_threadsafe(self.read(name, log_path, pipe, stream), self.loop)
+        self.readers.add(future)
+        future.add_done_callback(self.readers.discard)
+
+    async def read(self, name, log_path, pipe, stream):
+        # 1行ずつではなく読めるだけまとめて読み込み，行に分けてから記録する
+        reader = asyncio.StreamReader(limit=LOG_READ_SIZE)
+        transport, _ = await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        partial = b''
+        try:
+            while True:
+                data = await reader.read(LOG_READ_SIZE)
+                if not data:
+                    break
+                lines = (partial + data).split(b'\n')
+                partial = lines.pop()
+                if len(partial) >= LOG_READ_SIZE:
+                    lines.append(partial)
+                    partial = b''
+                if lines:
+                    self.record(name, log_path, stream, lines)
+            # 改行の無い最後の行
+            if partial:
+                self.record(name, log_path, stream, [partial])
+        finally:
+            transport.close()
+
+    def record(self, name, log_path, stream, lines):
+        monotonic, now = round(time.monotonic(), 6), round(time.time(), 3)
+        entries = [{'t': monotonic, 'time': now, 'component': name, 'stream': stream,
+                    'line': line.decode('utf-8', 'replace').rstrip('\r')} for line in lines]
+        self.buffers[name].extend(entries)
+        try:
+            self.queue.put_nowait((log_path, entries))
+        except queue.Full:
+            self.dropped[name] = self.dropped.get(name, 0) + len(entries)
+
+    def write_lines(self):
+        files = {}
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            log_path, entries = item
+            if log_path not in files:
+                files[log_path] = RotatingLog(log_path)
+            files[log_path].write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries).encode())
+            # 溜まった行を書き終えたら logs --follow から見えるようにする
+            if self.queue.empty():
+                for log in files.values():
+                    log.flush()
+        for log in files.values():
+            log.close()
+
+    def tail(self, name, lines=LOG_CRASH_LINES):
+        """ コンポーネントの直近の出力 """
+        return list(self.buffers.get(name, ()))[-lines:]
+
+    def close(self, timeout=5.0):
+        """ 終了したコンポーネントの出力を最後まで保存して，スレッドを停止する """
+        wait(list(self.readers), timeout)
+        self.queue.put(None)
+        self.writer.join(timeout)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        for name, count in self.dropped.items():
+            print(f"{name}: 書き込みが追いつかなかった出力 {count}行を破棄しました")
+
+
+def parse_log_line(line):
+    """ ログファイルの1行を読む（JSONでない行はそのまま本文として扱う） """
+    try:
+        entry = json.loads(line)
+        if isinstance(entry, dict) and 'line' in entry:
+            return entry
+    except ValueError:
         pass
+    return {'time': None, 'component': None, 'stream': 'stdout', 'line': line.rstrip('\n')}
+
+
+def format_log_entry(entry):
+    """ 例: '12:34:56.789 sensor_system/camerapublish.py | ...'（stderr は '!' で示す） """
+    if entry.get('time') is None:
+        return entry['line']
+    clock = time.strftime('%H:%M:%S', time.localtime(entry['time'])) + f".{int(entry['time'] * 1000) % 1000:03d}"
+    mark = '!' if entry.get('stream') == 'stderr' else '|'
+    return f"{clock} {entry['component']} {mark} {entry['line']}"
+
+
+############################## ヘッドレス起動(プロセス監視) ##############################
+def component_name(entry):
+    """ run の項目からコンポーネント名を作る（例: 'sensor_system camerapublish.py' → 'sensor_system/camerapublish.py'） """
+    return '/'.join(str(entry).split()[:2])
+
+
+class Supervisor:
+    """
+    端末を使わずに各コンポーネントを個別のプロセスグループで起動し，監視する．
+    出力は LogPipeline でコンポーネントごとのログファイルに保存し，異常終了した場合は間隔を伸ばしながら再起動する．
+    """
+
+    def __init__(self, log_dir=None, state_path=None):
+        self.log_dir = log_dir or os.path.join(cache_dir, 'log', 'run')
+        self.state_path = state_path or os.path.join(cache_dir, 'run', 'processes.json')
+        # stop/restart <component> を実行した別プロセスからの依頼
+        self.control_path = os.path.join(os.path.dirname(self.state_path), 'control.json')
+        self.control_mtime = None
+        self.handled = {}
+        self.components = {}
+        self.lock = threading.RLock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.logs = LogPipeline()
+        os.makedirs(self.log_dir, exist_ok=True)
+        # 前回の実行で残った依頼は扱わない
+        if os.path.exists(self.control_path):
+            os.remove(self.control_path)
+
+    def start(self, name, command, cwd=None):
+        """ コンポーネントを起動し，監視対象に加える """
+        with self.lock:
+            log_path = os.path.join(self.log_dir, name.replace('/', '__') + '.log')
+            component = {'name': name, 'command': command, 'cwd': cwd, 'log': log_path, 'proc': None,
+                         'restarts': 0, 'backoff': RESTART_BACKOFF, 'next_start': 0.0, 'started': 0.0,
+                         'desired': 'running'}
+            self.components[name] = component
+            self._spawn(component)
+            return component['proc']
+
+    def _spawn(self, component):
+        # パイプ越しでも rosconsole の出力が溜まらないよう行単位でバッファリングさせる
+        env = dict(ros_environment(), ROSCONSOLE_STDOUT_LINE_BUFFERED='1')
+        proc = subprocess.Popen(["bash", "-c", component['command']], cwd=component['cwd'], env=env,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                start_new_session=True)
+        self.logs.attach(component['name'], component['log'], proc.stdout, 'stdout')
+        self.logs.attach(component['name'], component['log'], proc.stderr, 'stderr')
+        component['proc'] = proc
+        component['started'] = time.monotonic()
+        component['start_time'] = process_start_time(component['proc'].pid)
+        trace_instant(f"start {component['name']}", pid=component['proc'].pid, command=component['command'])
+        print(f"{component['name']} を起動しました (pid {component['proc'].pid})")
+        self.write_state()
+
+    def poll(self):
+        """ 終了したコンポーネントを検出し，必要なら再起動する """
+        self.check_control()
+        with self.lock:
+            now = time.monotonic()
+            for component in self.components.values():
+                proc = component['proc']
+                if proc is None:
+                    if component['next_start'] and now >= component['next_start']:
+                        component['restarts'] += 1
+                        self._spawn(component)
+                    continue
+
+                returncode = proc.poll()
+                if returncode is None:
+                    continue
+
+                component['proc'] = None
+                if returncode == 0:
+                    print(f"{component['name']} が終了しました")
+                    component['next_start'] = 0.0
+                    self.write_state()
+                    continue
+
+                if now - component['started'] > RESTART_RESET:
+                    component['backoff'] = RESTART_BACKOFF
+                print(f"{component['name']} が異常終了しました(終了コード {returncode})．"
+                      f"{component['backoff']:.1f}秒後に再起動します (log: {component['log']})")
+                for entry in self.logs.tail(component['name']):
+                    print(f"    {format_log_entry(entry)}")
+                component['next_start'] = now + component['backoff']
+                component['backoff'] = min(component['backoff'] * 2, RESTART_BACKOFF_MAX)
+                self.write_state()
+
+    def supervise(self, interval=0.5):
+        while not self.stopping.wait(interval):
+            self.poll()
+
+    def start_monitor(self):
+        """ 監視スレッドを開始する """
+        self.thread = threading.Thread(target=self.supervise, daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        """ Ctrl+C (SIGINT/SIGTERM) を受けるまで待つ """
+        try:
+            while self.thread.is_alive():
+                self.thread.join(1.0)
+        except KeyboardInterrupt:
+            pass
+
+    def _terminate(self, proc, timeout=10.0):
+        """
+        プロセスグループに SIGTERM を送り，timeout 秒以内に終了しなければ SIGKILL を送る．
+        別のプロセスグループになった子孫のプロセス（roslaunchのノードなど）も残っていれば SIGKILL を送る．
+        """
+        descendants = descendant_processes({proc.pid})
+        deadline = time.monotonic() + timeout
+        send_signal(proc.pid, signal.SIGTERM)
+        try:
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            send_signal(proc.pid, signal.SIGKILL)
+            proc.wait()
+        kill_remaining(descendants, deadline)
+        trace_instant(f"stop {proc.pid}", pid=proc.pid)
+
+    def stop(self, name, timeout=10.0):
+        """ コンポーネントを停止し，監視対象から外す """
+        with self.lock:
+            component = self.components.pop(name, None)
+            self.write_state()
+        if component is None or component['proc'] is None:
+            return
+
+        self._terminate(component['proc'], timeout)
+        print(f"{name} を停止しました")
+
+    def halt(self, name, timeout=10.0):
+        """ コンポーネントを停止する（監視対象には残し，restart されるまで再起動しない） """
+        with self.lock:
+            component = self.components.get(name)
+            if component is None:
+                return False
+            proc, component['proc'] = component['proc'], None
+            component['desired'] = 'stopped'
+            component['next_start'] = 0.0
+            self.write_state()
+
+        if proc is not None:
+            self._terminate(proc, timeout)
+        print(f"{name} を停止しました")
+        return True
+
+    def restart(self, name, timeout=10.0):
+        """ コンポーネント1つだけを停止して起動し直す（停止中の場合は起動する） """
+        with self.lock:
+            component = self.components.get(name)
+            if component is None:
+                return False
+            # 停止させている間に poll() が異常終了として再起動しないよう先に外す
+            proc, component['proc'] = component['proc'], None
+            component['next_start'] = 0.0
+
+        if proc is not None:
+            self._terminate(proc, timeout)
+        with self.lock:
+            component['desired'] = 'running'
+            component['backoff'] = RESTART_BACKOFF
+            self._spawn(component)
+        return True
+
+    def check_control(self):
+        """ 別プロセス(stop/restart <component>)からの依頼を読み込み，別スレッドで実行する """
+        try:
+            mtime = os.stat(self.control_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self.control_mtime:
+            return
+        self.control_mtime = mtime
+
+        actions = {'stop': self.halt, 'restart': self.restart}
+        for name, request in load_json(self.control_path).items():
+            if self.handled.get(name) == request.get('id') or request.get('action') not in actions:
+                continue
+            self.handled[name] = request.get('id')
+            threading.Thread(target=actions[request['action']], args=(name,), daemon=True).start()
+
+    def stop_all(self, timeout=10.0):
+        """ 全コンポーネントのプロセスグループに SIGTERM を送り，終了しなければ SIGKILL を送る """
+        self.stopping.set()
+        with self.lock:
+            procs = [component['proc'] for component in self.components.values() if component['proc'] is not None]
+            descendants = descendant_processes({proc.pid for proc in procs})
+            for proc in procs:
+                send_signal(proc.pid, signal.SIGTERM)
+
+            deadline = time.monotonic() + timeout
+            for proc in procs:
+                try:
+                    proc.wait(max(0.0, deadline - time.monotonic()))
+                except subprocess.TimeoutExpired:
+                    send_signal(proc.pid, signal.SIGKILL)
+                    proc.wait()
+            kill_remaining(descendants, deadline)
+
+            for component in self.components.values():
+                component['proc'] = None
+            self.write_state()
+        self.logs.close()
+
+    def write_state(self):
+        """ 起動中のコンポーネントのPID等をファイルに書き出す """
+        state = {'supervisor': os.getpid(), 'supervisor_start_time': process_start_time(os.getpid()), 'components': {}}
+        for name, component in self.components.items():
+            proc = component['proc']
+            state['components'][name] = {
+                'pid': proc.pid if proc is not None else None,
+                'pgid': proc.pid if proc is not None else None,
+                'command': component['command'],
+                'cwd': component['cwd'],
+                'log': component['log'],
+                'restarts': component['restarts'],
+                'desired': component['desired'],
+                'start_time': component.get('start_time') if proc is not None else None,
+            }
+        save_json(self.state_path, state)
+
+
+############################## リソース使用量の計測(テレメトリ) ##############################
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# (メトリクス名, 種類, 説明, 値のキー)
+METRICS = [
+    ('rtsi_component_up', 'gauge', "コンポーネントが起動中なら1", 'up'),
+    ('rtsi_component_cpu_seconds_total', 'counter', "コンポーネントのプロセス(子孫を含む)のCPU時間[s]", 'cpu'),
+    ('rtsi_component_cpu_percent', 'gauge', "直近の計測間隔でのCPU使用率[%]", 'cpu_percent'),
+    ('rtsi_component_resident_memory_bytes', 'gauge', "コンポーネントのプロセスのRSS[byte]", 'rss'),
+    ('rtsi_component_threads', 'gauge', "コンポーネントのプロセスのスレッド数", 'threads'),
+    ('rtsi_component_processes', 'gauge', "コンポーネントのプロセス数", 'processes'),
+    ('rtsi_component_restarts_total', 'counter', "異常終了による再起動の回数", 'restarts'),
+]
+
+
+def process_start_time(pid):
+    """ プロセスの開始時刻（起動からのclock tick．PIDの再利用を見分けるために使う） """
+    try:
+        with open(f"/proc/{pid}/stat", 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    return int(data[data.rfind(b')') + 2:].split()[19])
+
+
+def process_table():
+    """ /proc/<pid>/stat から全プロセスの親PID・プロセスグループ・CPU時間・RSS・スレッド数を読む """
+    table = {}
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat", 'rb') as f:
+                data = f.read()
+        except OSError:
+            continue
+        # コマンド名に空白や括弧が含まれることがあるため最後の ')' 以降を分割する
+        fields = data[data.rfind(b')') + 2:].split()
+        table[int(entry.name)] = {
+            'state': fields[0].decode(), 'ppid': int(fields[1]), 'pgrp': int(fields[2]), 'start': int(fields[19]),
+            # 終了して回収された子プロセスの分(cutime, cstime)も含め，子が終了しても減らないようにする
+            'cpu': sum(int(value) for value in fields[11:15]) / CLOCK_TICKS,
+            'threads': int(fields[17]), 'rss': int(fields[21]) * PAGE_SIZE,
+        }
+    return table
+
+
+def process_children(table):
+    """ 親PID → 子PIDのリスト """
+    children = {}
+    for pid, info in table.items():
+        children.setdefault(info['ppid'], []).append(pid)
+    return children
+
+
+def component_usage(table, children, root):
+    """
+    コンポーネントのCPU時間・RSS・スレッド数・プロセス数を集計する（root が終了している場合は None）．
+    roslaunch は各ノードを setsid で別のプロセスグループにして起動するため，
+    root のプロセスグループに加えて親子関係(PPid)をたどった子孫のプロセスも含める．
+    """
+    if root not in table:
+        return None
+    members = {pid for pid, info in table.items() if info['pgrp'] == root}
+    visited = set()
+    stack = [root]
+    while stack:
+        pid = stack.pop()
+        if pid not in visited:
+            visited.add(pid)
+            stack.extend(children.get(pid, []))
+    members |= visited
+    usage = {'cpu': 0.0, 'rss': 0, 'threads': 0, 'processes': len(members)}
+    for pid in members:
+        for key in ('cpu', 'rss', 'threads'):
+            usage[key] += table[pid][key]
+    return usage
+
+
+def metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Telemetry:
+    """
+    Supervisor で起動したコンポーネント（プロセスグループと子孫のプロセス）のリソース使用量を定期的に計測し，
+    Prometheusのテキスト形式でファイルに書き出す（path）・HTTPで公開する（port の /metrics）．
+    """
+
+    def __init__(self, supervisors, interval=METRICS_INTERVAL, path=None, port=None):
+        self.supervisors = supervisors
+        self.interval = interval
+        self.path = path
+        self.port = port
+        self.previous = {}
+        self.text = ''
+        self.stopping = threading.Event()
+        self.server = None
+
+    def sample(self):
+        """ 全コンポーネントを1回計測し，Prometheusのテキスト形式にする """
+        table = process_table()
+        children = process_children(table)
+        now = time.monotonic()
+        samples = []
+        for robot, supervisor in self.supervisors.items():
+            with supervisor.lock:
+                components = [(name, component['proc'].pid if component['proc'] is not None else None,
+                               component['restarts']) for name, component in supervisor.components.items()]
+
+            for name, pgid, restarts in components:
+                group = component_usage(table, children, pgid) if pgid else None
+                sample = dict(group or {'cpu': 0.0, 'rss': 0, 'threads': 0, 'processes': 0})
+                sample.update({'up': 1 if group else 0, 'restarts': restarts, 'cpu_percent': 0.0})
+
+                previous = self.previous.get((robot, name))
+                if group and previous and previous[0] == pgid and now > previous[2]:
+                    sample['cpu_percent'] = max(0.0, (group['cpu'] - previous[1]) / (now - previous[2]) * 100)
+                self.previous[(robot, name)] = (pgid, sample['cpu'], now)
+                samples.append((f'robot="{metric_label(robot)}",component="{metric_label(name)}"', sample))
+
+        lines = []
+        for metric, kind, description, key in METRICS:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.extend(f"{metric}{{{labels}}} {round(sample[key], 3)}" for labels, sample in samples)
+        self.text = '\n'.join(lines) + '\n'
+
+        if self.path:
+            # node_exporter の textfile collector などが途中の内容を読まないよう置き換える
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.text)
+            os.replace(tmp_path, self.path)
+        return self.text
+
+    def measure(self):
+        while True:
+            self.sample()
+            if self.stopping.wait(self.interval):
+                break
+
+    def serve(self):
+        """ 127.0.0.1:port で /metrics を公開する """
+        telemetry = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = telemetry.text.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', int(self.port)), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"メトリクスを公開しています: http://127.0.0.1:{self.server.server_address[1]}/metrics")
+
+    def start(self):
+        """ 計測スレッドを開始する """
+        if self.port is not None:
+            self.serve()
+        threading.Thread(target=self.measure, daemon=True).start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def start_telemetry(supervisors, options):
+    """ --metrics FILE / --metrics-port PORT が指定されていればテレメトリを開始する """
+    if not options.get('metrics') and not options.get('metrics_port'):
+        return None
+    if not supervisors:
+        print("--metrics, --metrics-port は --headless の時のみ使用できます")
+        return None
+    telemetry = Telemetry(supervisors, float(options.get('metrics_interval', METRICS_INTERVAL)),
+                          options.get('metrics'), options.get('metrics_port'))
+    telemetry.start()
+    return telemetry
+
+
+######### Start name server ##################### 
+@traced
+def nameserver(supervisor=None):
+    missing = services_to_start()
+    if 'roscore' in missing:
+        print("roscoreが起動していません。roscoreを起動します...")
+        if supervisor is not None:
+            supervisor.start("roscore", "roscore")
+        else:
+            call_command(["gnome-terminal", "--", "roscore"])
+
+        invalidate_service('roscore')
+        if not wait_until(probe_rosmaster, READY_TIMEOUT):
+            print("roscoreの起動を確認できませんでした")
+
     else:
-        leng_rtm = len(leng_rtm)   
+        print("roscoreはすでに起動しています．")
 
-        for index in range(leng_rtm):
+    if 'nameserver' in missing:
+        print("nameserverが起動していません。namaserverを起動します...")
+        result = run_command(["locale"], capture_output=True, text=True)
+        matching_lines = [line for line in result.stdout.splitlines() if "en" in line]
 
-            was_rep1  = config['run']['rtm'][index]
-            print(was_rep1)
+        username = os.environ['USER']
+        with trace_span("wasanbon-admin.py nameserver start", 'subprocess'):
+            child = pexpect.spawn("wasanbon-admin.py nameserver start", encoding='utf-8')
+            if not len(matching_lines) > 0:
+                child.expect(f"{username} のパスワード:")
+            else:
+                child.expect(f"password for {username}:")
 
-            command = ["wasanbon-admin.py", "package", "directory_show" f"{was_rep1}"]
-            dir_name = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = dir_name.communicate()
-            stdout = stdout.decode('utf-8').strip()
-            os.chdir(str(stdout))
+            child.sendline(username)
+            if supervisor is None:
+                child.interact()
+            else:
+                child.expect(pexpect.EOF, timeout=None)
+        invalidate_service('nameserver')
 
-            command = "./mgr.py system run -v"
-            P = subprocess.Popen(["gnome-terminal", "--tab", "--", "bash", "-c", command])
+    else:
+        print("nameserverはすでに起動しています．")
 
-# YAMLからシナリオを読み込みサービス名とタスクを抽出する
-def scenario_analyze(scenario_path):
-   
-    os.chdir(system_dir)
+############################## 起動準備の確認(readiness probe) ##############################
+def ros_master_uri():
+    return os.environ.get('ROS_MASTER_URI', 'http://localhost:11311')
 
-    scenario_data = load_yaml(scenario_path)
-    scenario = scenario_data.get('scenario', [])
 
-    tasks = []
-    functions = []
-    for task in scenario:
-        task_name = task.get('task', '')
-        task_arg = task.get('arg', '')
+def probe_port(host, port, timeout=0.5):
+    """ TCPポートに接続できるか確認する """
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
 
-        tasks.append((task_name, task_arg))
+class TimeoutTransport(xmlrpc.client.Transport):
+    """ 応答しないrosmasterを待ち続けないよう，接続にタイムアウトを設定するXML-RPCのトランスポート """
 
-        if task_name not in functions:
-            functions.append(task_name)
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        # xmlrpc.client.Transport.make_connection と同じ（HTTPConnection に timeout を渡す）
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        self._connection = host, http.client.HTTPConnection(chost, timeout=self.timeout)
+        return self._connection[1]
+
+
+def ros_master(timeout=1.0):
+    """ rosmasterのXML-RPCクライアント """
+    return xmlrpc.client.ServerProxy(ros_master_uri(), transport=TimeoutTransport(timeout))
+
+
+def probe_rosmaster():
+    """ rosmasterが応答するか確認する """
+    try:
+        code, _, _ = ros_master().getPid('/rtsi')
+        return code == 1
+    except (OSError, xmlrpc.client.Error):
+        return False
+
+
+def probe_nameserver():
+    """ omniNamesのポートが開いているか確認する """
+    return probe_port('localhost', NAMESERVER_PORT)
+
+
+def ros_system_state():
+    """ rosmasterから [publishers, subscribers, services] を取得する """
+    try:
+        code, _, state = ros_master().getSystemState('/rtsi')
+        return state if code == 1 else None
+    except (OSError, xmlrpc.client.Error):
+        return None
+
+
+# rtls(rtshell)が見つからなかった場合はTrue（以降は実行しない）
+rtls_missing = False
+
+
+def probe_rtc(name):
+    """ RTCがネームサーバに登録されているか確認する（rtshell が無い場合は常にFalse） """
+    global rtls_missing
+    if rtls_missing:
+        return False
+    try:
+        result = run_command(["rtls", "-R", f"localhost:{NAMESERVER_PORT}"], capture_output=True, text=True)
+    except OSError as e:
+        print(f"rtls を実行できないため，RTCの準備完了を確認できません（rtshell をインストールしてください）: {e}")
+        rtls_missing = True
+        return False
+    entries = result.stdout.split()
+    return any(entry in (f"{name}.rtc", f"{name}0.rtc") or entry.endswith((f"/{name}.rtc", f"/{name}0.rtc"))
+               for entry in entries)
+
+
+def probe_ready(ready, cache):
+    """
+    ready(プローブの指定)を全て満たすか確認する．
+    cacheには1回の確認の間で共有するrosmasterの状態を保存する．
+
+        port: 11311 / 'host:port'   TCPポートが開いている
+        topic: /name                トピックがpublishされている
+        service: /name              サービスが登録されている
+        param: /name                パラメータが設定されている
+        node: /name                 ノードが登録されている
+        rtc: Name                   RTCがネームサーバに登録されている
+    """
+    for kind, value in ready.items():
+        if kind == 'port':
+            host, _, port = str(value).rpartition(':')
+            ok = probe_port(host or 'localhost', port)
+        elif kind in ('topic', 'service', 'node'):
+            if 'state' not in cache:
+                cache['state'] = ros_system_state()
+            state = cache['state']
+            if state is None:
+                ok = False
+            elif kind == 'topic':
+                ok = any(topic == value for topic, _ in state[0])
+            elif kind == 'service':
+                ok = any(service == value for service, _ in state[2])
+            else:
+                ok = any(value in nodes for section in state for _, nodes in section)
+        elif kind == 'param':
+            try:
+                ok = ros_master().hasParam('/rtsi', value)[2]
+            except (OSError, xmlrpc.client.Error):
+                ok = False
+        elif kind == 'rtc':
+            ok = probe_rtc(value)
         else:
+            # parse_run_section で検証済みのため通常は来ない
+            ok = False
+        if not ok:
+            return False
+    return True
+
+
+def wait_until(probe, timeout, interval=0.1):
+    """ probeがTrueを返すまで待つ（タイムアウトしたらFalse） """
+    deadline = time.monotonic() + timeout
+    while not probe():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+############################## サービスの死活確認 ##############################
+# nameserver() で起動するサービス（probe: 応答の確認，executable: プロセスの実行ファイル名）
+SERVICES = {
+    'roscore': {'probe': probe_rosmaster, 'executable': 'rosmaster'},
+    'nameserver': {'probe': probe_nameserver, 'executable': 'omniNames'},
+}
+
+# 確認結果のキャッシュ（このプロセスが終了するまで有効．起動した場合は invalidate_service で消す）
+service_status = {}
+
+INTERPRETERS = ('python', 'python2', 'python3', 'bash', 'sh')
+
+
+def find_processes(executable):
+    """
+    /proc を走査し，実行ファイル名が完全に一致するプロセスのPIDを返す．
+    `python3 /opt/ros/noetic/bin/rosmaster` のようにインタプリタ経由で起動したものも対象にする．
+    """
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", 'rb') as f:
+                argv = [os.path.basename(arg.decode('utf-8', 'replace')) for arg in f.read().split(b'\0') if arg]
+        except OSError:
+            continue
+        if not argv:
+            continue
+        if argv[0] == executable or (len(argv) > 1 and argv[0].startswith(INTERPRETERS) and argv[1] == executable):
+            pids.append(int(entry))
+    return pids
+
+
+def service_alive(name, refresh=False):
+    """
+    サービス(roscore / nameserver)が動作しているか確認する．
+    ポートへの応答を確認し，応答が無ければ /proc からプロセスを探す．
+    """
+    if refresh or name not in service_status:
+        service = SERVICES[name]
+        service_status[name] = service['probe']() or bool(find_processes(service['executable']))
+    return service_status[name]
+
+
+def invalidate_service(name):
+    """ サービスを起動・停止した後に確認結果のキャッシュを消す """
+    service_status.pop(name, None)
+
+
+def services_to_start():
+    """ まだ動作していないサービスの名前を返す """
+    return [name for name in SERVICES if not service_alive(name)]
+
+
+############################## コンポーネントの起動 ##############################
+# 暗黙の依存先（nameserver() で起動するもの）の準備完了の判定
+BASE_SERVICES = {name: service['probe'] for name, service in SERVICES.items()}
+
+
+def run_components(run_config):
+    """
+    runセクション(RunConfig)から起動するコンポーネントの一覧を作る．
+    各項目は文字列，または次の形式の辞書で書ける．
+
+        - cmd: sensor_system Detection.py
+          name: detection                         # 省略時は sensor_system/Detection.py
+          after: [seed_r7_bringup/moveit.launch]  # 先に準備完了している必要があるコンポーネント
+          ready: {topic: /detection}              # 準備完了の判定（省略時は起動した時点で完了）
+          timeout: 30
+    """
+    components = []
+    if not run_config.keys:
+        print("No run section")
+        return components
+
+    for kind, label in (('roslaunch', 'ROS_LAUNCH'), ('rosrun', 'ROS_RUN'), ('rtm', 'RTM')):
+        if kind not in run_config.keys:
+            print(f"No {label} module")
+            continue
+
+        for entry in getattr(run_config, kind):
+            spec = dict(entry) if isinstance(entry, dict) else {'cmd': entry}
+            cmd = str(spec.get('cmd') or spec.get('name'))
+            after = ['nameserver' if kind == 'rtm' else 'roscore'] + list(spec.get('after') or [])
+            components.append({'kind': kind, 'name': str(spec.get('name') or component_name(cmd)), 'cmd': cmd,
+                               'after': after, 'ready': spec.get('ready') or {},
+                               'timeout': float(spec.get('timeout', READY_TIMEOUT))})
+    return components
+
+
+############################## RTCパッケージの索引 ##############################
+# パッケージ名 → ディレクトリ（rtc_package_index() で作成）
+rtc_index = {'signature': None, 'packages': {}}
+
+
+def wasanbon_workspace_file():
+    """ wasanbonに登録されたパッケージの一覧ファイル """
+    wasanbon_home = os.environ.get('WASANBON_HOME', os.path.join(home_path, '.wasanbon'))
+    return os.path.join(wasanbon_home, 'workspace.yaml')
+
+
+def rtc_index_signature():
+    """ rtm_ws と wasanbonの登録ファイルの更新時刻（変わったら索引を作り直す） """
+    signature = []
+    for path in (rtm_ws, wasanbon_workspace_file()):
+        try:
+            signature.append([path, os.stat(path).st_mtime_ns])
+        except OSError:
+            signature.append([path, 0])
+    return signature
+
+
+def build_rtc_package_index():
+    """ wasanbonの登録ファイルと rtm_ws を走査して パッケージ名 → ディレクトリ の索引を作る """
+    packages = {}
+
+    registry = wasanbon_workspace_file()
+    if os.path.exists(registry):
+        for name, path in (load_yaml(registry) or {}).items():
+            if isinstance(path, str):
+                packages[str(name)] = os.path.expanduser(path)
+
+    if os.path.isdir(rtm_ws):
+        for entry in sorted(os.listdir(rtm_ws)):
+            path = os.path.join(rtm_ws, entry)
+            if os.path.isfile(os.path.join(path, 'mgr.py')):
+                packages.setdefault(entry, path)
+
+    return packages
+
+
+def rtc_package_index():
+    """ RTCパッケージの索引を返す（メモリ → ディスクのキャッシュ → 走査 の順） """
+    signature = rtc_index_signature()
+    if rtc_index['signature'] == signature:
+        return rtc_index['packages']
+
+    index_path = os.path.join(cache_dir, 'rtc_index.json')
+    cached = load_json(index_path)
+    if cached.get('signature') == signature:
+        packages = cached['packages']
+    else:
+        packages = build_rtc_package_index()
+        save_json(index_path, {'signature': signature, 'packages': packages})
+
+    rtc_index['signature'] = signature
+    rtc_index['packages'] = packages
+    return packages
+
+
+def resolve_rtc_directory(name):
+    """ RTCパッケージのディレクトリを返す（索引に無ければ wasanbon に問い合わせる） """
+    path = rtc_package_index().get(name)
+    if path and os.path.isdir(path):
+        return path
+
+    result = run_command(["wasanbon-admin.py", "package", "directory_show", f"{name}"],
+                         capture_output=True, text=True)
+    path = result.stdout.strip()
+    if result.returncode == 0 and os.path.isdir(path):
+        return path
+    return None
+
+
+def start_component(name, command, supervisor=None, cwd=None):
+    """ コンポーネントを起動する（supervisorが無い場合はgnome-terminalのタブで起動） """
+    if supervisor is not None:
+        return supervisor.start(name, command, cwd)
+    trace_instant(f"start {name}", command=command)
+    return subprocess.Popen(["gnome-terminal", "--tab", "--", "bash", "-c", command], cwd=cwd, env=ros_environment())
+
+
+def launch_component(component, supervisor=None):
+    """ コンポーネントの種類に応じたコマンドで起動する """
+    cwd = None
+    if component['kind'] == 'rtm':
+        cwd = resolve_rtc_directory(component['cmd'])
+        if cwd is None:
+            raise OSError(f"パッケージ {component['cmd']} のディレクトリが見つかりません")
+        command = "./mgr.py system run -v"
+    else:
+        command = f"{component['kind']} {component['cmd']}"
+
+    return start_component(component['name'], command, supervisor, cwd=cwd)
+
+
+def pending_dependencies(pending, name):
+    """ 起動待ちのコンポーネント name が(推移的に)待っている起動待ちのコンポーネント """
+    found = set()
+    stack = [name]
+    while stack:
+        for dep in pending[stack.pop()]['after']:
+            if dep in pending and dep not in found:
+                found.add(dep)
+                stack.append(dep)
+    return found
+
+
+@traced
+def launch_components(components, supervisor=None, state=None):
+    """
+    依存先(after)の準備ができたコンポーネントから順に起動する．
+    依存関係の無いものは並行して起動・準備確認を行う．
+    stateには準備完了・失敗したコンポーネント名を保存し，複数回の呼び出しで共有できる．
+    """
+    if state is None:
+        state = {'ready': set(), 'failed': set()}
+    ready, failed = state['ready'], state['failed']
+    known = set(BASE_SERVICES) | ready | failed | {component['name'] for component in components}
+
+    processes = {}
+    pending = {component['name']: component for component in components}
+    starting = {}
+    launch_start = time.monotonic()
+
+    while pending or starting:
+        progress = False
+        cache = {}
+
+        for name in [name for name in BASE_SERVICES if name not in ready]:
+            if any(name in component['after'] for component in pending.values()) and BASE_SERVICES[name]():
+                ready.add(name)
+                progress = True
+
+        for name, component in list(pending.items()):
+            unknown = [dep for dep in component['after'] if dep not in known]
+            blocked = [dep for dep in component['after'] if dep in failed]
+            if not unknown and not blocked and time.monotonic() - launch_start > component['timeout']:
+                blocked = [dep for dep in component['after'] if dep in BASE_SERVICES and dep not in ready]
+            if unknown or blocked:
+                print(f"{name} を起動できません（依存先: {unknown or blocked}）")
+                failed.add(name)
+                del pending[name]
+                progress = True
+            elif all(dep in ready for dep in component['after']):
+                try:
+                    proc = launch_component(component, supervisor)
+                    processes[name] = proc.pid
+                    starting[name] = (component, time.monotonic())
+                except OSError as e:
+                    print(f"Failed to start {component['kind']} process {component['cmd']}: {e}")
+                    failed.add(name)
+                del pending[name]
+                progress = True
+
+        for name, (component, started) in list(starting.items()):
+            if probe_ready(component['ready'], cache):
+                print(f"{name} の準備ができました ({time.monotonic() - started:.1f}s)")
+                trace_record(f"ready {name}", 'launch', started - time.monotonic() + time.perf_counter(), time.perf_counter())
+                ready.add(name)
+            elif time.monotonic() - started > component['timeout']:
+                print(f"{name} の準備が {component['timeout']:.0f}秒以内に完了しませんでした")
+                failed.add(name)
+            else:
+                continue
+            del starting[name]
+            progress = True
+
+        if not progress and not starting:
+            # 起動待ちのコンポーネント同士で待ち合っている（after の循環）．循環に含まれるものを失敗にし，
+            # それに依存するものは次の周回で依存先の失敗として扱う
+            cyclic = [name for name in pending if name in pending_dependencies(pending, name)]
+            for name in cyclic:
+                print(f"{name} を起動できません（依存関係が循環しています: {pending[name]['after']}）")
+                failed.add(name)
+                del pending[name]
+                progress = True
+
+        if not progress:
+            time.sleep(0.1)
+
+    return processes
+
+
+@traced
+def run(yml_path, supervisor=None, state=None):
+    print(yml_path)
+
+    return launch_components(run_components(load_run_config(yml_path)), supervisor, state)
+
+############################## 起動計画のキャッシュ ##############################
+# 起動計画の形式を変えた場合は番号を上げてキャッシュを無効にする
+LAUNCH_PLAN_VERSION = 1
+
+
+def launch_plan_key(robot_path, scenario_path, engine_name):
+    """ ロボットファイル・シナリオファイル・engineのhri.xmlの内容から起動計画のキーを作る """
+    digest = hashlib.sha1(f"{LAUNCH_PLAN_VERSION}:{engine_name}".encode())
+    for path in (robot_path, scenario_path, os.path.join(ros_ws, "src", str(engine_name), "hri.xml")):
+        digest.update(hash_file(path).encode())
+    return digest.hexdigest()
+
+
+@traced
+def compile_launch_plan(robot, scenario, work_dir=None):
+    """
+    起動するコンポーネントの一覧(起動計画)を作る．
+    ロボットファイルのrunセクション → HRI機能 の順に起動する2段階の計画で，
+    入力が変わっていなければキャッシュした計画をそのまま使う．
+    """
+    engine_name = robot.engine
+    key = launch_plan_key(robot.path, scenario.path, engine_name)
+    plan_path = os.path.join(cache_dir, 'launch_plans', f"{key}.json")
+    plan = load_json(plan_path)
+    if plan.get('key') == key:
+        print(f"起動計画のキャッシュを使用します: {plan_path}")
+        return plan
+
+    stages = [run_components(robot.run)]
+
+    print(f"HRI package {engine_name}")
+    launch_file = analyze2(engine_name, robot.path, scenario.functions, work_dir)
+    stages.append(run_components(load_run_config(launch_file)))
+
+    plan = {'key': key, 'robot': robot.path, 'scenario': scenario.path, 'engine': engine_name, 'stages': stages}
+    save_json(plan_path, plan)
+    return plan
+
+
+############################## シナリオに合わせたHRI機能の起動(--lazy) ##############################
+def task_windows(scenario):
+    """ HRI機能ごとに (最初に使うタスクの番号, 最後に使うタスクの番号) """
+    windows = {}
+    for index, task in enumerate(scenario.tasks):
+        first, _ = windows.get(task.task, (index, index))
+        windows[task.task] = (first, index)
+    return windows
+
+
+def scenario_step(param=SCENARIO_STEP_PARAM):
+    """ サービスアプリケーションが実行中のタスク番号（未設定・取得できない場合はNone） """
+    try:
+        code, _, value = ros_master().getParam('/rtsi', param)
+    except (OSError, xmlrpc.client.Error):
+        return None
+    return value if code == 1 and isinstance(value, int) else None
+
+
+def function_components(components, engine, functions):
+    """ HRI機能名 → そのスクリプトのコンポーネント（analyze2 が作る "engine 機能名.py" の項目） """
+    by_name = {component['name']: component for component in components}
+    return {function: by_name[f"{engine}/{function}.py"] for function in functions
+            if f"{engine}/{function}.py" in by_name}
+
+
+def needed_functions(windows, step, lookahead):
+    """ タスク step を実行中に起動しておくHRI機能（step 〜 step+lookahead で使い始め，まだ使い終わっていないもの） """
+    return {function for function, (first, last) in windows.items() if first <= step + lookahead and last >= step}
+
+
+def lazy_activation(components, scenario, supervisor, launch_state, lookahead=LAZY_LOOKAHEAD,
+                    param=SCENARIO_STEP_PARAM, interval=0.5, step_timeout=LAZY_STEP_TIMEOUT):
+    """
+    シナリオの進行(param のタスク番号)に合わせてHRI機能のコンポーネントを起動・停止する．
+    使い始める lookahead タスク前に起動して準備を重ね，以降のタスクで使わなくなったものは停止する．
+    supervisor が停止するかシナリオが最後まで進むと終了する．
+    step_timeout 秒たっても param が設定されない場合（サービスアプリケーションが対応していない場合）は，
+    残りのHRI機能を全て起動して終了する．
+    """
+    windows = task_windows(scenario)
+    active = set()
+    step = 0
+    seen = False
+    deadline = time.monotonic() + step_timeout
+    while True:
+        current = scenario_step(param)
+        if current is not None:
+            step = max(step, current)
+            seen = True
+        elif not seen and time.monotonic() >= deadline:
+            remaining = [function for function in components if function not in active]
+            print(f"警告: {step_timeout:g}秒たっても {param} が設定されません．"
+                  f"残りのHRI機能 {remaining} を起動します")
+            launch_components([components[function] for function in remaining], supervisor, launch_state)
+            return
+
+        needed = needed_functions(windows, step, lookahead)
+        for function in sorted(active - needed):
+            supervisor.stop(components[function]['name'])
+            launch_state['ready'].discard(components[function]['name'])
+            active.discard(function)
+
+        starting = [function for function in components if function in needed and function not in active]
+        if starting:
+            print(f"タスク {step}: {starting} を起動します")
+            launch_components([components[function] for function in starting], supervisor, launch_state)
+            active.update(starting)
+
+        if step >= len(scenario.tasks) or supervisor.stopping.wait(interval):
+            break
+    print("シナリオが終了したため，HRI機能の起動・停止を終了します")
+
+
+def start_lazy_activation(components, scenario, supervisor, launch_state, lookahead=LAZY_LOOKAHEAD,
+                          param=SCENARIO_STEP_PARAM, step_timeout=LAZY_STEP_TIMEOUT):
+    """ lazy_activation を別スレッドで開始する """
+    # 前回のシナリオのタスク番号が残っていると最初から停止してしまうため削除する
+    try:
+        ros_master().deleteParam('/rtsi', param)
+    except (OSError, xmlrpc.client.Error):
+        pass
+    thread = threading.Thread(target=lazy_activation, daemon=True,
+                              args=(components, scenario, supervisor, launch_state, lookahead, param),
+                              kwargs={'step_timeout': step_timeout})
+    thread.start()
+    return thread
+
+
+############################## ロボットごとの実行環境 ##############################
+@dataclass
+class RobotContext:
+    """
+    ロボット1台分の設定と，生成するファイルの保存先．
+    ワークスペース(ros_ws, rtm_ws)はロボット間で共有し，
+    統合collectファイル・起動用yaml・プロセスの状態・ログは work_dir に分けて保存する．
+    """
+    name: str
+    robot: RobotConfig
+    scenario: Scenario
+    work_dir: str
+
+    @property
+    def log_path(self):
+        """ フリートモードでのこのロボットの出力先 """
+        return os.path.join(self.work_dir, 'log', f"{self.name}.log")
+
+    @property
+    def state_path(self):
+        """ --headless で起動したコンポーネントの状態ファイル """
+        return os.path.join(self.work_dir, 'run', 'processes.json')
+
+    def supervisor(self):
+        """ このロボットのコンポーネントを監視する Supervisor """
+        return Supervisor(os.path.join(self.work_dir, 'log', 'run'), self.state_path)
+
+
+# YAMLからロボット・シナリオを読み込みサービス名とタスクを抽出する
+@traced
+def robot_context(robot_name, scenario_name, system_dir, name=None, work_dir=None):
+    """ system_dir の <robot_name>.yaml と <scenario_name>.yaml から RobotContext を作る """
+    robot = load_robot_config(os.path.join(system_dir, f"{robot_name}.yaml"))
+    scenario = load_scenario(os.path.join(system_dir, f"{scenario_name}.yaml"))
+    return RobotContext(name or robot_name, robot, scenario, work_dir or cache_dir)
+
+############################## 停止・個別の再起動 ##############################
+# 停止を依頼してから完了を待つ時間[s]
+STOP_TIMEOUT = 10.0
+
+
+def tracked_state_paths():
+    """ --headless で起動した全てのコンポーネントの状態ファイル（単体・フリートの各ロボット） """
+    paths = [os.path.join(cache_dir, 'run', 'processes.json')]
+    paths += sorted(glob.glob(os.path.join(cache_dir, 'robots', '*', 'run', 'processes.json')))
+    return [path for path in paths if os.path.exists(path)]
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def recorded_process_alive(pid, start_time):
+    """ 状態ファイルに記録したプロセスが動作中か（PIDが別のプロセスに再利用されていないかも確認する） """
+    return bool(pid) and start_time is not None and process_start_time(pid) == start_time
+
+
+def process_group_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def send_signal(target, signum, group=True):
+    """ プロセスグループ(group=False の場合はプロセス)にシグナルを送る（送れたらTrue．権限が無い場合は表示する） """
+    try:
+        (os.killpg if group else os.kill)(target, signum)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        print(f"{'プロセスグループ' if group else 'プロセス'} {target} を停止する権限がありません")
+        return False
+
+
+def descendant_processes(roots, group=True):
+    """
+    roots(プロセスグループ，group=False の場合はプロセス)の子孫のプロセス: PID → 開始時刻．
+    roslaunch は各ノードを setsid で別のプロセスグループにするため，プロセスグループへのシグナルでは届かない．
+    親が終了すると init に引き取られて親子関係をたどれなくなるため，シグナルを送る前に記録しておく．
+    """
+    if not roots:
+        return {}
+    table = process_table()
+    children = process_children(table)
+    stack = [pid for pid, info in table.items() if (info['pgrp'] if group else pid) in roots]
+    found = {}
+    while stack:
+        for child in children.get(stack.pop(), []):
+            if child not in found and child != os.getpid():
+                found[child] = table[child]['start']
+                stack.append(child)
+    return found
+
+
+def process_running(pid, start_time):
+    """ 記録したプロセスが終了していないか（ゾンビは終了したものとして扱う） """
+    try:
+        with open(f"/proc/{pid}/stat", 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+    except OSError:
+        return False
+    return fields[0] != b'Z' and int(fields[19]) == start_time
+
+
+def kill_remaining(processes, deadline):
+    """ deadline まで processes(PID → 開始時刻)の終了を待ち，残ったものに SIGKILL を送る．SIGKILL を送ったものを返す """
+    remaining = dict(processes)
+    while remaining:
+        remaining = {pid: start for pid, start in remaining.items() if process_running(pid, start)}
+        if not remaining or time.monotonic() >= deadline:
+            break
+        time.sleep(0.1)
+    return [pid for pid in remaining if send_signal(pid, signal.SIGKILL, group=False)]
+
+
+def terminate_processes(ids, timeout=STOP_TIMEOUT, group=True):
+    """
+    プロセスグループ(group=False の場合はプロセス)に並列に SIGTERM を送り，
+    timeout 秒以内に終了しなかったものに SIGKILL を送る．SIGKILL を送ったものを返す．
+    別のプロセスグループになった子孫のプロセス（roslaunchのノードなど）も，残っていれば SIGKILL を送る．
+    """
+    alive = process_group_alive if group else process_alive
+    own = {os.getpgrp(), 0} if group else {os.getpid(), 0}
+    targets = set(ids) - own
+    descendants = descendant_processes(targets, group)
+
+    pending = {target for target in targets if send_signal(target, signal.SIGTERM, group)}
+
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        pending = {target for target in pending if alive(target)}
+        if pending:
+            time.sleep(0.1)
+
+    killed = [target for target in pending if send_signal(target, signal.SIGKILL, group)]
+    return sorted(killed + kill_remaining(descendants, deadline))
+
+
+@traced
+def stop_all_processes(timeout=STOP_TIMEOUT):
+    """
+    起動した全てのプロセスを停止する．
+    1. --headless で監視しているプロセスに停止を依頼する（停止したコンポーネントを再起動させないため先に行う）
+    2. 残ったコンポーネント・端末で起動したROSノードとRTC(mgr.py)のプロセスグループを並列に停止する
+    3. roscore・ネームサーバを停止する
+    """
+    supervisors = []
+    groups = []
+    for path in tracked_state_paths():
+        state = load_json(path)
+        if state.get('supervisor') != os.getpid() and recorded_process_alive(state.get('supervisor'),
+                                                                              state.get('supervisor_start_time')):
+            supervisors.append(state['supervisor'])
+        groups += [component['pgid'] for component in state.get('components', {}).values()
+                   if recorded_process_alive(component.get('pgid'), component.get('start_time'))]
+    if supervisors:
+        print(f"監視中のプロセスを停止します: {supervisors}")
+        # Supervisor は自身のコンポーネントを停止してから終了するため，その時間も待つ
+        terminate_processes(supervisors, timeout * 2, group=False)
+
+    if service_alive('roscore', refresh=True):
+        call_command(["rosnode", "kill", "-a"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for pid in find_processes('mgr.py'):
+        try:
+            groups.append(os.getpgid(pid))
+        except ProcessLookupError:
             pass
+    groups = [pgid for pgid in dict.fromkeys(groups) if process_group_alive(pgid)]
+    killed = terminate_processes(groups, timeout)
+    print(f"コンポーネントを停止しました: {len(groups)}件（SIGKILL: {len(killed)}件）")
+
+    services = []
+    for executable in ['roslaunch', 'roscore'] + [service['executable'] for service in SERVICES.values()]:
+        for pid in find_processes(executable):
+            try:
+                services.append(os.getpgid(pid))
+            except ProcessLookupError:
+                pass
+    if services:
+        terminate_processes(services, timeout)
+        print("roscore・ネームサーバを停止しました")
+    for name in SERVICES:
+        invalidate_service(name)
+
+
+def find_component(name):
+    """
+    状態ファイルからコンポーネントを探し，[(状態ファイル, コンポーネント名)] を返す．
+    名前は完全一致，またはファイル名部分（sensor_system/Detection.py に対する Detection.py）で探す．
+    フリートでは "ロボット名:コンポーネント名" でロボットを指定できる．
+    """
+    robot, sep, component_name = name.rpartition(':')
+    matches = []
+    for path in tracked_state_paths():
+        robot_dir = os.path.dirname(os.path.dirname(path))
+        if sep and os.path.basename(robot_dir) != robot:
+            continue
+        names = load_json(path).get('components', {})
+        exact = [item for item in names if item == component_name]
+        matches += [(path, item) for item in exact or [item for item in names if item.split('/')[-1] == component_name]]
+    return matches
+
+
+def resolve_component(name):
+    """ find_component で1つに決まった (状態ファイル, コンポーネント名) を返す．見つからない・複数ある場合は None """
+    matches = find_component(name)
+    if not matches:
+        print(f"コンポーネント {name} が見つかりません（run --headless で起動したものが対象です）")
+        return None
+    if len(matches) > 1:
+        print(f"コンポーネント {name} が複数あります: " +
+              ', '.join(f"{os.path.basename(os.path.dirname(os.path.dirname(path)))}:{item}" for path, item in matches))
+        return None
+    return matches[0]
+
+
+@traced
+def control_component(name, action, timeout=STOP_TIMEOUT):
+    """
+    コンポーネント1つだけを停止(action='stop')・再起動(action='restart')する．
+    --headless で監視しているプロセスに依頼し，完了するまで待つ．
+    監視しているプロセスが無い場合，stop はプロセスグループを直接停止する．
+    """
+    match = resolve_component(name)
+    if match is None:
+        return False
+
+    state_path, name = match
+    state = load_json(state_path)
+    component = state['components'][name]
+    if not recorded_process_alive(state.get('supervisor'), state.get('supervisor_start_time')):
+        if action == 'stop' and recorded_process_alive(component.get('pgid'), component.get('start_time')):
+            terminate_processes([component['pgid']], timeout)
+            print(f"{name} を停止しました")
+            return True
+        print("コンポーネントを監視しているプロセス(run --headless)がありません")
+        return False
+
+    control_path = os.path.join(os.path.dirname(state_path), 'control.json')
+    control = load_json(control_path)
+    control[name] = {'action': action, 'id': time.time_ns()}
+    save_json(control_path, control)
+
+    deadline = time.monotonic() + timeout * 2
+    while time.monotonic() < deadline:
+        current = load_json(state_path).get('components', {}).get(name, {})
+        if action == 'stop' and current.get('desired') == 'stopped' and current.get('pid') is None:
+            print(f"{name} を停止しました")
+            return True
+        if action == 'restart' and current.get('pid') and current.get('pid') != component.get('pid'):
+            print(f"{name} を再起動しました (pid {current['pid']})")
+            return True
+        time.sleep(0.1)
+    print(f"{name} の{'停止' if action == 'stop' else '再起動'}が完了しませんでした")
+    return False
+
+
+def show_logs(name=None, lines=50, follow=False):
+    """
+    run --headless で起動したコンポーネントのログを表示する．
+    name を省略した場合はコンポーネントとログファイルの一覧を表示する．
+    follow=True の場合は Ctrl+C まで追記された行を表示し続ける（ローテーションされたら新しいファイルを読む）．
+    """
+    if name is None:
+        for path in tracked_state_paths():
+            robot = os.path.basename(os.path.dirname(os.path.dirname(path)))
+            for item, component in load_json(path).get('components', {}).items():
+                print(f"{robot}:{item}  {component.get('log')}")
+        return True
+
+    match = resolve_component(name)
+    if match is None:
+        return False
+    state_path, name = match
+    log_path = load_json(state_path)['components'][name].get('log')
+    if not log_path or not os.path.exists(log_path):
+        print(f"{name} のログがありません")
+        return False
+
+    # 直近の lines 行（ローテーション済みのファイルも古い順に読む）
+    recent = collections.deque(maxlen=lines)
+    for path in [f"{log_path}.{index}" for index in range(LOG_BACKUPS, 0, -1)] + [log_path]:
+        if os.path.exists(path):
+            with open(path, encoding='utf-8', errors='replace') as f:
+                recent.extend(f)
+    for line in recent:
+        print(format_log_entry(parse_log_line(line)))
+    if not follow:
+        return True
+
+    f = open(log_path, encoding='utf-8', errors='replace')
+    f.seek(0, os.SEEK_END)
+    pending = ''
+    try:
+        while True:
+            pending += f.readline()
+            if pending.endswith('\n'):
+                print(format_log_entry(parse_log_line(pending)), flush=True)
+                pending = ''
+                continue
+            try:
+                rotated = os.stat(log_path).st_ino != os.fstat(f.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = False
+            if rotated:
+                f.close()
+                f = open(log_path, encoding='utf-8', errors='replace')
+            else:
+                time.sleep(0.2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        f.close()
+    return True
+
+def collect_options(options):
+    """ collect の gitリポジトリの取得方法・照合に関するオプション """
+    return {'mirror': not options.get('no_mirror', False), 'depth': options.get('git_depth'),
+            'filter_spec': options.get('git_filter'), 'offline': bool(options.get('offline')),
+            'reconcile': not options.get('reinstall', False), 'dry_run': bool(options.get('dry_run'))}
+
+
+def bundle_directory(options):
+    return options.get('bundle_dir', os.path.join(cache_dir, 'bundle'))
 
-    return functions
 
-def stop_all_processes():
-    subprocess.call(["rosnode", "kill", "-a"])
+def index_directory(options):
+    """ オフライン索引のディレクトリ（index が作成し，--offline の解析が読む） """
+    return options.get('index_dir', os.path.join(cache_dir, 'index'))
+
+
+def artifact_directory(options):
+    """ build のビルド成果物のキャッシュ（--no-artifact-cache で使わない） """
+    if options.get('no_artifact_cache'):
+        return None
+    return options.get('artifact_cache', artifact_cache_dir)
+
+
+def run_robot(ctx, supervisor=None, options=None):
+    """
+    ロボット1台分のコンポーネントを起動計画に従って起動する．
+    --lazy の場合，HRI機能はシナリオの進行に合わせて起動・停止する（--headless の時のみ）．
+    タスク番号のパラメータが --step-timeout 秒たっても設定されなければ，残りのHRI機能を全て起動する．
+    """
+    options = options or {}
+    plan = compile_launch_plan(ctx.robot, ctx.scenario, ctx.work_dir)
+
+    nameserver(supervisor)
+    launch_state = {'ready': set(), 'failed': set()}
+    *stages, hri_stage = plan['stages']
+    for stage in stages:
+        launch_components(stage, supervisor, launch_state)
+
+    lazy = options.get('lazy') and supervisor is not None
+    if options.get('lazy') and supervisor is None:
+        print("--lazy は --headless の時のみ使用できます．全てのHRI機能を起動します")
+
+    deferred = function_components(hri_stage, ctx.robot.engine, ctx.scenario.functions) if lazy else {}
+    launch_components([component for component in hri_stage if component not in deferred.values()],
+                      supervisor, launch_state)
+    if deferred:
+        start_lazy_activation(deferred, ctx.scenario, supervisor, launch_state,
+                              int(options.get('lookahead', LAZY_LOOKAHEAD)),
+                              options.get('step_param', SCENARIO_STEP_PARAM),
+                              float(options.get('step_timeout', LAZY_STEP_TIMEOUT)))
+    return launch_state
+
+
+def main(ctx, command, options, target=None):
+    robot = ctx.robot
+    service = robot.engine
+    functions = ctx.scenario.functions
+
+    if command == 'collect':
+        jobs = int(options.get('jobs', FETCH_WORKERS))
+        batch = not options.get('no_batch', False)
 
-def main(robot_path, service, functions):
-    if args[3] == 'collect':
         print("collect robot packages")
-        collect(robot_path)
+        packages = collect(robot.collect, jobs, install=False, **collect_options(options))
+        # HRI engineを取得したらシナリオを検証してから依存関係の解析・インストールを行う
+        # （--dry-run では engine を取得していない場合があるため警告のみ）
+        if options.get('dry_run'):
+            warn_scenarios([ctx])
+        else:
+            validate_context(ctx)
+
+        if options.get('dry_run'):
+            # 計画の表示のみ: engine のチェックアウトに collect用yaml を生成せず，既存のものだけを使う
+            dependencies = planned_dependencies(service, functions)
+        else:
+            print("analyze modules")
+            install_file = analyze(service,functions, jobs, bool(options.get('offline')), ctx.work_dir,
+                                   index_directory(options))
+            print(install_file)
+            dependencies = load_collect_config(install_file) if install_file else None
+
+        # ロボットファイルと統合collectファイルの apt/pip をまとめてインストール
+        # --bundle: bundle で作成したバンドルからインストールする（インデックスにアクセスしない）
+        print("collect dependencies modules")
+        bundle_dir = bundle_directory(options) if options.get('bundle') else None
+        collect(dependencies, jobs, pending=packages, batch=batch, bundle_dir=bundle_dir, **collect_options(options))
+        if not options.get('dry_run'):
+            post_collect_hooks(robot.collect.rtm)
+
+    elif command == 'bundle':
+        bundle_dir = bundle_directory(options)
+        jobs = int(options.get('jobs', FETCH_WORKERS))
+        validate_context(ctx)
 
         print("analyze modules")
-        install_file = analyze(service,functions)
-        print(install_file)
+        install_file = analyze(service, functions, jobs, bool(options.get('offline')), ctx.work_dir,
+                               index_directory(options))
+        dependencies = load_collect_config(install_file) if install_file else CollectConfig()
 
-        print("collect dependencies modules")
-        collect(install_file)
+        print(f"create bundle {bundle_dir}")
+        lacking = create_bundle(unique_items(robot.collect.apt + dependencies.apt),
+                                unique_items(robot.collect.pip + dependencies.pip), bundle_dir)
+        if lacking:
+            sys.exit(1)
 
-    elif args[3] == 'build':
+    elif command == 'build':
         print("system build")
-        build(robot_path, service)
+        validate_context(ctx)
+        build(robot, service, bool(options.get('force')), options.get('jobs'), artifact_directory(options))
 
-    elif args[3] == 'run':
+    elif command == 'run':
         print("sytem run")
-        nameserver()
-        run(robot_path)
-        
-        print(f"HRI package {service}")
+        validate_context(ctx)
+        # --headless: 端末を使わずに起動し，このプロセスで監視・再起動を行う
+        supervisor = None
+        if options.get('headless'):
+            supervisor = ctx.supervisor()
+            supervisor.start_monitor()
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        # --metrics FILE, --metrics-port PORT: コンポーネントごとのリソース使用量を公開する
+        telemetry = start_telemetry({ctx.name: supervisor} if supervisor else {}, options)
 
-        launch_file = analyze2(service, robot_path, functions)
-        
-        run(launch_file)
+        try:
+            run_robot(ctx, supervisor, options)
+
+            try:
+                user_input = input("サービスアプリケーションを実行しますか：(Y/N)")
+            except EOFError:
+                user_input = "N"
+            if user_input == "Y" or user_input == "y":
+                if supervisor is not None:
+                    supervisor.start("rois_env/service_app.py", "rosrun rois_env service_app.py")
+                else:
+                    trace_instant("start rois_env/service_app.py")
+                    P = subprocess.Popen(["gnome-terminal", "--", "bash", "-c", "rosrun rois_env service_app.py"],
+                                         env=ros_environment())
+
+            if supervisor is not None:
+                print("コンポーネントを監視しています．Ctrl+C で全て停止します")
+                supervisor.wait()
+        finally:
+            if telemetry is not None:
+                telemetry.stop()
+            if supervisor is not None:
+                supervisor.stop_all()
+
+    elif command == 'stop':
+        # stop <component>: そのコンポーネントだけを停止する
+        if target is not None:
+            if not control_component(target, 'stop'):
+                sys.exit(1)
+        else:
+            stop_all_processes()
 
-        user_input = input("サービスアプリケーションを実行しますか：(Y/N)")
-        if user_input == "Y" or user_input == "y":
-            P = subprocess.Popen(["gnome-terminal", "--", "bash", "-c", "rosrun rois_env service_app.py"])
+    elif command == 'restart':
+        if target is None or not control_component(target, 'restart'):
+            sys.exit(1)
 
-    elif args[3] == 'stop':
-        stop_all_processes()
+    elif command == 'logs':
+        # logs [component] [--follow] [--lines N]
+        if not show_logs(target, int(options.get('lines', 50)), bool(options.get('follow'))):
+            sys.exit(1)
     
-    elif args[3] == 'nameserver':
+    elif command == 'validate':
+        # シナリオのHRI機能が engine にあるかだけを確認する
+        validate_context(ctx)
+        print(f"{ctx.scenario.path}: OK ({len(functions)} HRI機能)")
+
+    elif command == 'scan':
+        print(f"scan HRI engine package {service}")
+        generate_collect_fragments(service, None if options.get('all') else functions,
+                                   int(options.get('jobs', os.cpu_count() or 1)),
+                                   bool(options.get('offline')), bool(options.get('force')), index_directory(options))
+
+    elif command == 'index':
+        print("update offline package index")
+        update_offline_index(index_directory(options))
+
+    elif command == 'nameserver':
         print("sytem run")
         nameserver()
 
     else :
         print("finish")
 
+
+############################## 複数ロボットの一括運用(フリート) ##############################
+# ロボットに依存しないため，フリートでも1回だけ実行するコマンド
+FLEET_SHARED_COMMANDS = ['stop', 'restart', 'logs', 'index', 'nameserver']
+
+
+def load_fleet(fleet, system_dir):
+    """
+    --fleet の指定からロボットごとの RobotContext を作る．
+    指定は "ロボット:シナリオ,..." の形式，または次の形式のyamlファイル．
+
+        fleet:
+          - robot: seed_noid
+            scenario: scenario_a
+            name: noid_1        # 省略時はロボット名（同じロボットファイルを複数使う場合は必須）
+    """
+    if os.path.isfile(fleet):
+        data = load_yaml(fleet) or {}
+        entries = data.get('fleet') if isinstance(data, dict) else None
+        if not isinstance(entries, list):
+            raise ConfigError(f"{fleet}: fleet: ロボットのリストがありません")
+    else:
+        entries = []
+        for pair in fleet.split(','):
+            robot_name, sep, scenario_name = pair.strip().partition(':')
+            entries.append({'robot': robot_name, 'scenario': scenario_name if sep else None})
+
+    contexts = []
+    errors = []
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get('robot') or not entry.get('scenario'):
+            errors.append(f"fleet[{index}]: robot と scenario を指定してください")
+            continue
+        name = str(entry.get('name') or entry['robot'])
+        if any(ctx.name == name for ctx in contexts):
+            errors.append(f"fleet[{index}]: ロボット名 {name} が重複しています（name を指定してください）")
+            continue
+        try:
+            contexts.append(robot_context(entry['robot'], entry['scenario'], system_dir, name,
+                                          os.path.join(cache_dir, 'robots', name)))
+        except (ConfigError, OSError) as e:
+            errors.append(str(e))
+
+    if errors:
+        raise ConfigError('\n'.join(errors))
+    return contexts
+
+
+def merge_collect_configs(configs):
+    """ 複数のcollectセクションを1つにまとめる（同じパッケージ・リポジトリは1回だけ取得する） """
+    merged = CollectConfig()
+    for config in configs:
+        for key in COLLECT_LIST_KEYS:
+            setattr(merged, key, unique_items(getattr(merged, key) + getattr(config, key)))
+        for repository in config.git:
+            same = [item for item in merged.git if item.repo == repository.repo]
+            if not same:
+                merged.git.append(repository)
+            elif same[0] != repository:
+                print(f"リポジトリ {repository.repo} の指定がロボットによって異なります．{same[0]} を使用します")
+    return merged
+
+
+def merge_run_configs(configs):
+    """ 複数のrunセクションを1つにまとめる（fleetのビルド対象を求めるため．dictの指定もそのまま残す） """
+    merged = RunConfig()
+    for config in configs:
+        for key in ('roslaunch', 'rosrun', 'rtm', 'keys'):
+            items = getattr(merged, key)
+            items += [item for item in getattr(config, key) if item not in items]
+    return merged
+
+
+def fleet_dependencies(contexts, options):
+    """ ロボットごとの依存関係(統合collectファイル)を求める．同じHRI機能の組み合わせは1回だけ解析する """
+    jobs = int(options.get('jobs', FETCH_WORKERS))
+    analyzed = {}
+    dependencies = []
+    for ctx in contexts:
+        key = (ctx.robot.engine, tuple(ctx.scenario.functions))
+        if key not in analyzed and options.get('dry_run'):
+            analyzed[key] = planned_dependencies(ctx.robot.engine, ctx.scenario.functions)
+        elif key not in analyzed:
+            print(f"analyze modules {ctx.name}")
+            install_file = analyze(ctx.robot.engine, ctx.scenario.functions, jobs, bool(options.get('offline')),
+                                   ctx.work_dir, index_directory(options))
+            analyzed[key] = load_collect_config(install_file) if install_file else CollectConfig()
+        dependencies.append(analyzed[key])
+    return dependencies
+
+
+def validate_fleet(contexts):
+    """ 全ロボットのシナリオを検証し，誤りがあればまとめて ConfigError にする（索引は1回だけ読む） """
+    catalog = engine_catalog()
+    errors = [f"{ctx.name}: {error}" for ctx in contexts for error in validate_scenario(ctx.robot, ctx.scenario, catalog)]
+    if errors:
+        raise ConfigError('\n'.join(errors))
+
+
+def run_in_robot_contexts(contexts, function):
+    """ ロボットごとに function(ctx) を並行して実行する（出力は各ロボットのログに保存） """
+    failed = []
+
+    def run_one(ctx):
+        with robot_output(ctx.log_path):
+            with trace_span(f"robot {ctx.name}", 'fleet'):
+                return function(ctx)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(contexts))) as executor:
+        futures = {executor.submit(run_one, ctx): ctx for ctx in contexts}
+        for future in as_completed(futures):
+            ctx = futures[future]
+            try:
+                future.result()
+                print(f"[OK  ] {ctx.name} (ログ: {ctx.log_path})")
+            except (Exception, SystemExit) as e:
+                print(f"[NG  ] {ctx.name}: {e!r} (ログ: {ctx.log_path})")
+                failed.append(ctx.name)
+    return failed
+
+
+@traced
+def fleet_main(contexts, command, options, target=None):
+    """
+    複数のロボットをまとめて運用する．
+    collect・bundle・build はロボット間で共通の取得・ビルドをまとめて1回だけ行い，
+    run などロボットごとの処理は並行して実行する．
+    """
+    print(f"fleet: {[ctx.name for ctx in contexts]}")
+    if command in ('bundle', 'build', 'run', 'validate'):
+        validate_fleet(contexts)
+
+    if command == 'collect':
+        jobs = int(options.get('jobs', FETCH_WORKERS))
+        batch = not options.get('no_batch', False)
+
+        # HRI engineを先に取得してから依存関係を解析し，apt/pip は最後にまとめてインストールする
+        print("collect robot packages")
+        packages = collect(merge_collect_configs([ctx.robot.collect for ctx in contexts]), jobs, install=False,
+                           **collect_options(options))
+        if options.get('dry_run'):
+            warn_scenarios(contexts)
+        else:
+            validate_fleet(contexts)
+        dependencies = merge_collect_configs(fleet_dependencies(contexts, options))
+
+        print("collect dependencies modules")
+        bundle_dir = bundle_directory(options) if options.get('bundle') else None
+        collect(dependencies, jobs, pending=packages, batch=batch, bundle_dir=bundle_dir, **collect_options(options))
+        if not options.get('dry_run'):
+            for first in unique_items(ctx.robot.collect.rtm[0] for ctx in contexts if ctx.robot.collect.rtm):
+                post_collect_hooks([first])
+
+    elif command == 'bundle':
+        dependencies = fleet_dependencies(contexts, options)
+        merged = merge_collect_configs([ctx.robot.collect for ctx in contexts] + dependencies)
+        if create_bundle(merged.apt, merged.pip, bundle_directory(options)):
+            sys.exit(1)
+
+    elif command == 'build':
+        # rtmパッケージはまとめて1回，catkin はHRI engineごとに1回ビルドする
+        # runセクションだけが参照するROSパッケージも rosdep・catkin の対象にする
+        merged = merge_collect_configs([ctx.robot.collect for ctx in contexts])
+        run = merge_run_configs([ctx.robot.run for ctx in contexts])
+        engines = unique_items(ctx.robot.engine for ctx in contexts if ctx.robot.engine != "None")
+        for engine in engines or ["None"]:
+            print(f"system build {engine}")
+            build(RobotConfig('fleet', merged, run, {}), engine, bool(options.get('force')), options.get('jobs'),
+                  artifact_directory(options))
+
+    elif command == 'run':
+        # roscore・ネームサーバはロボット間で共有し，コンポーネントはロボットごとに監視する
+        base = None
+        supervisors = {}
+        if options.get('headless'):
+            base = Supervisor()
+            base.start_monitor()
+            for ctx in contexts:
+                supervisors[ctx.name] = ctx.supervisor()
+                supervisors[ctx.name].start_monitor()
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        telemetry = start_telemetry(dict(supervisors, **{'shared': base}) if base else {}, options)
+
+        try:
+            nameserver(base)
+            failed = run_in_robot_contexts(contexts, lambda ctx: run_robot(ctx, supervisors.get(ctx.name), options))
+            if failed:
+                print(f"起動に失敗したロボット: {failed}")
+
+            if supervisors:
+                print("コンポーネントを監視しています．Ctrl+C で全て停止します")
+                base.wait()
+        finally:
+            if telemetry is not None:
+                telemetry.stop()
+            for supervisor in list(supervisors.values()) + [base]:
+                if supervisor is not None:
+                    supervisor.stop_all()
+
+    elif command == 'validate':
+        print(f"{len(contexts)}台のシナリオ: OK")
+
+    elif command in FLEET_SHARED_COMMANDS:
+        main(contexts[0], command, options, target)
+
+    elif command == 'scan':
+        # 同じHRI engineは1回だけ解析する
+        scanned = []
+        for ctx in contexts:
+            key = (ctx.robot.engine, tuple(ctx.scenario.functions))
+            if key not in scanned:
+                scanned.append(key)
+                main(ctx, command, options)
+
+    else :
+        print("finish")
+
+
 if __name__ == '__main__':
     print("start")
     rtsi_dir = "RTSI_FW"
 
-    args = sys.argv
-
-    print(f"ROBOT NAME :{args[1]}")    
-
+    args, options = parse_options(sys.argv)
     system_dir = f"{home_path}/{rtsi_dir}"  
-    robot_path = f"{system_dir}/{args[1]}.yaml"
-    scenario_path = f"{system_dir}/{args[2]}.yaml"
 
-    service_package = load_yaml(robot_path)['collect']['engine'][0]
-    functions = scenario_analyze(scenario_path)
-
-    ### ロボットファイル・シナリオファイル・扱うサービスパッケージを用いて運用開始
-    print(robot_path, service_package, functions)
-    main(robot_path, service_package, functions)
\ No newline at end of file
+    try:
+        if options.get('fleet'):
+            # --fleet robotA:scenarioA,robotB:scenarioB <command>（またはフリートのyamlファイル）
+            command = args[1] if len(args) > 1 else None
+            with trace_span(f"fleet {command}"):
+                contexts = load_fleet(options['fleet'], system_dir)
+                fleet_main(contexts, command, options, args[2] if len(args) > 2 else None)
+        else:
+            print(f"ROBOT NAME :{args[1]}")    
+            command = args[3] if len(args) > 3 else None
+            with trace_span(command or 'main'):
+                # ロボットファイル・シナリオファイルは最初に1回だけ読み込んで検証し，各処理に渡す
+                ctx = robot_context(args[1], args[2], system_dir)
+
+                ### ロボットファイル・シナリオファイル・扱うサービスパッケージを用いて運用開始
+                print(ctx.robot.path, ctx.robot.engine, ctx.scenario.functions)
+                main(ctx, command, options, args[4] if len(args) > 4 else None)
+    except ConfigError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        # --trace out.json: 計測したspanをChromeのtrace形式で保存する
+        if options.get('trace'):
+            write_trace(options['trace'])
+        print_trace_summary()
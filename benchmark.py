@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Systemoperate.py のベンチマーク
+
+git, apt, pip, wasanbon-admin.py, catkin, rosdep, roslaunch, rosrun などを
+遅延と失敗率を設定できる偽のコマンドに置き換え，実機やネットワーク無しで
+collect / (2回目の)collect / build / run / stop の処理時間・サブプロセス数・最大RSSを計測する．
+
+    python3 benchmark.py --sizes 10,100,1000 --latency 0.05 --failure-rate 0.01
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import argparse
+import threading
+import subprocess
+from xmlrpc.server import SimpleXMLRPCServer
+
+SYSTEMOPERATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Systemoperate.py')
+
+PHASES = ['collect', 'recollect', 'build', 'run', 'stop']
+# サブコマンドと異なる名前の計測（recollect: ワークスペースを一部変更してから2回目の collect）
+PHASE_COMMANDS = {'recollect': 'collect'}
+
+# run のコンポーネントの起動が完了したことを示す出力
+RUN_READY_MARKER = "コンポーネントを監視しています"
+
+# 短時間で終了する偽のコマンド（共通部分）
+FAKE_TOOL_HEADER = '''#!{python}
+import os, sys, time, random
+tool = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+with open(os.environ['RTSI_FAKE_LOG'], 'a') as log:
+    log.write(tool + ' ' + ' '.join(args) + '\\n')
+key = tool.upper().replace('-', '_').replace('.', '_')
+time.sleep(float(os.environ.get('RTSI_FAKE_' + key + '_LATENCY', os.environ.get('RTSI_FAKE_LATENCY', '0'))))
+failure_rate = float(os.environ.get('RTSI_FAKE_' + key + '_FAILURE', os.environ.get('RTSI_FAKE_FAILURE', '0')))
+failed = random.random() < failure_rate
+'''
+
+FAKE_TOOLS = {
+    'git': '''
+def set_branch(checkout, branch):
+    # 本物のgitと同じ形式の HEAD とローカルブランチを書く
+    os.makedirs(os.path.join(checkout, '.git', 'refs', 'heads'), exist_ok=True)
+    with open(os.path.join(checkout, '.git', 'HEAD'), 'w') as f:
+        f.write('ref: refs/heads/' + branch + '\\n')
+    open(os.path.join(checkout, '.git', 'refs', 'heads', branch), 'w').close()
+
+checkout = args[args.index('-C') + 1] if '-C' in args else None
+if args[:1] == ['clone'] and '--mirror' in args and not failed:
+    os.makedirs(os.path.join(args[-1], 'refs'), exist_ok=True)
+elif args[:1] == ['clone'] and not failed:
+    dest = args[-1]
+    set_branch(dest, args[args.index('-b') + 1] if '-b' in args else 'master')
+    name = os.path.basename(dest.rstrip('/'))
+    os.makedirs(os.path.join(dest, name), exist_ok=True)
+    with open(os.path.join(dest, name, 'package.xml'), 'w') as f:
+        f.write('<package><name>' + name + '</name></package>')
+elif checkout and 'rev-parse' in args:
+    head = os.path.join(checkout, '.git', 'HEAD')
+    if not os.path.exists(head):
+        sys.exit(128)
+    print(open(head).read().strip().replace('ref: refs/heads/', ''))
+    sys.exit(0)
+elif checkout and 'show-ref' in args:
+    sys.exit(0 if os.path.exists(os.path.join(checkout, '.git', args[-1])) else 1)
+elif checkout and 'checkout' in args and not failed:
+    branch = args[args.index('-b') + 1] if '-b' in args else args[-1]
+    set_branch(checkout, branch)
+sys.exit(1 if failed else 0)
+''',
+    'wasanbon-admin.py': '''
+if args[:2] == ['repository', 'clone'] and not failed:
+    os.makedirs(args[2], exist_ok=True)
+    os.symlink(os.environ['RTSI_FAKE_MGR'], os.path.join(args[2], 'mgr.py'))
+elif args[:2] == ['package', 'directory_show'] and len(args) > 2:
+    print(os.path.join(os.environ['RTM_WS'], args[2]))
+elif args[:2] == ['nameserver', 'start']:
+    input('password for ' + os.environ.get('USER', '') + ':')
+sys.exit(1 if failed else 0)
+''',
+    'mgr.py': '''
+if args[:2] == ['system', 'run']:
+    os.execvp('sleep', ['sleep', '3600'])
+sys.exit(1 if failed else 0)
+''',
+}
+
+# sudo -S <command>: 標準入力のパスワードを読み捨てて実行する
+FAKE_SUDO = '''#!/bin/sh
+cat > /dev/null
+shift
+exec "$@"
+'''
+
+# 常駐する偽のコマンド（roslaunch / rosrun など）
+FAKE_DAEMON = '''#!/bin/sh
+echo "$(basename "$0") $*" >> "$RTSI_FAKE_LOG"
+exec sleep 3600
+'''
+
+SIMPLE_TOOLS = ['apt', 'pip', 'catkin', 'rosdep', 'rosnode', 'rtls', 'gnome-terminal', 'apt-cache']
+DAEMON_TOOLS = ['roslaunch', 'rosrun', 'roscore']
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_services():
+    """ rosmaster(XML-RPC) と omniNames(TCPポート) の代わりを起動する """
+    master = SimpleXMLRPCServer(('localhost', free_port()), logRequests=False, allow_none=True)
+    master.register_function(lambda caller: [1, '', os.getpid()], 'getPid')
+    master.register_function(lambda caller: [1, '', [[], [], []]], 'getSystemState')
+    master.register_function(lambda caller, key: [1, '', False], 'hasParam')
+    threading.Thread(target=master.serve_forever, daemon=True).start()
+
+    nameserver = socket.socket()
+    nameserver.bind(('localhost', 0))
+    nameserver.listen(128)
+
+    def accept():
+        while True:
+            conn, _ = nameserver.accept()
+            conn.close()
+    threading.Thread(target=accept, daemon=True).start()
+
+    return master, nameserver
+
+
+def install_fake_tools(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    header = FAKE_TOOL_HEADER.format(python=sys.executable)
+
+    def write(name, body):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(body)
+        os.chmod(path, 0o755)
+
+    for name, body in FAKE_TOOLS.items():
+        write(name, header + body)
+    for name in SIMPLE_TOOLS:
+        write(name, header + "sys.exit(1 if failed else 0)\n")
+    for name in DAEMON_TOOLS:
+        write(name, FAKE_DAEMON)
+    write('sudo', FAKE_SUDO)
+
+
+def make_workspace(root, size, robots=1):
+    """
+    size個のコンポーネントを持つロボットファイル・シナリオファイル・HRIエンジンを作る．
+    robots が2以上の場合はパッケージの大部分を共有するロボットファイルを robots 個作る（フリートモード）．
+    """
+    home = os.path.join(root, 'home')
+    system_dir = os.path.join(home, 'RTSI_FW')
+    ros_ws = os.path.join(root, 'catkin_ws')
+    rtm_ws = os.path.join(root, 'rtm_ws')
+    engine = 'bench_hri'
+    engine_dir = os.path.join(ros_ws, 'src', engine)
+    for path in (system_dir, rtm_ws, os.path.join(engine_dir, 'yaml'), os.path.join(engine_dir, 'scripts')):
+        os.makedirs(path, exist_ok=True)
+
+    quarter = max(1, size // 4)
+    functions = [f"Function_{i}" for i in range(max(1, size // 10))]
+
+    robot = {
+        'collect': {
+            'engine': [engine],
+            'rtm': [f"bench_rtc_{i}" for i in range(quarter)],
+            'apt': [f"bench-apt-{i}" for i in range(quarter)],
+            'pip': [f"bench-pip-{i}" for i in range(quarter)],
+            'git': [{'url': f"https://example.com/bench/repo_{i}.git", 'repo': f"repo_{i}",
+                     'branch': 'main' if i % 2 else None} for i in range(quarter)],
+        },
+        'run': {
+            'roslaunch': [f"bench_bringup launch_{i}.launch" for i in range(max(1, size // 10))],
+            'rosrun': [f"bench_nodes node_{i}.py" for i in range(size - max(1, size // 10) - quarter)],
+            'rtm': [f"bench_rtc_{i}" for i in range(quarter)],
+        },
+    }
+    scenario = {'scenario': [{'task': functions[i % len(functions)], 'act': 'bench', 'arg': i}
+                             for i in range(len(functions) * 2)]}
+
+    with open(os.path.join(system_dir, f"bench_{size}.yaml"), 'w') as f:
+        json.dump(robot, f)
+    fleet = [f"bench_{size}:bench_{size}_scenario"]
+    for r in range(1, robots):
+        robot['collect']['apt'] = robot['collect']['apt'][:quarter] + [f"bench-apt-robot-{r}"]
+        with open(os.path.join(system_dir, f"bench_{size}_r{r}.yaml"), 'w') as f:
+            json.dump(robot, f)
+        fleet.append(f"bench_{size}_r{r}:bench_{size}_scenario")
+    with open(os.path.join(system_dir, f"bench_{size}_scenario.yaml"), 'w') as f:
+        json.dump(scenario, f)
+
+    with open(os.path.join(engine_dir, 'package.xml'), 'w') as f:
+        f.write(f"<package><name>{engine}</name></package>")
+    with open(os.path.join(engine_dir, 'hri.xml'), 'w') as f:
+        f.write('<hri xmlns:gml="http://example.com/r/gml"><gml:filename>bench_engine</gml:filename></hri>')
+    for function in functions:
+        with open(os.path.join(engine_dir, 'scripts', f"{function}.py"), 'w') as f:
+            f.write("import rospy\n")
+        with open(os.path.join(engine_dir, 'yaml', f"{function}.yaml"), 'w') as f:
+            json.dump({'collect': {'rtm': [], 'apt': [f"{function.lower()}-apt"], 'pip': [], 'git': [], 'other': []}}, f)
+
+    return {'home': home, 'system_dir': system_dir, 'ros_ws': ros_ws, 'rtm_ws': rtm_ws,
+            'robot': f"bench_{size}", 'scenario': f"bench_{size}_scenario",
+            'fleet': ','.join(fleet) if robots > 1 else None}
+
+
+def run_phase(workspace, phase, env, extra_args, timeout):
+    """ Systemoperate.py を1回実行し，時間・最大RSS・終了コードを返す """
+    subcommand = PHASE_COMMANDS.get(phase, phase)
+    if workspace['fleet']:
+        command = [sys.executable, SYSTEMOPERATE, '--fleet', workspace['fleet'], subcommand] + extra_args
+    else:
+        command = [sys.executable, SYSTEMOPERATE, workspace['robot'], workspace['scenario'], subcommand] + extra_args
+    if phase == 'run':
+        command.append('--headless')
+
+    start = time.monotonic()
+    proc = subprocess.Popen(command, cwd=workspace['system_dir'], env=env, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    ready_time = None
+    output = []
+
+    def read_output():
+        nonlocal ready_time
+        for line in proc.stdout:
+            output.append(line)
+            if phase == 'run' and RUN_READY_MARKER in line and ready_time is None:
+                ready_time = time.monotonic() - start
+                proc.send_signal(signal.SIGTERM)
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+
+    if phase == 'run':
+        proc.stdin.write("N\n")
+        proc.stdin.flush()
+    proc.stdin.close()
+
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    timer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status
+    reader.join(5)
+
+    return {'wall': time.monotonic() - start, 'ready': ready_time, 'peak_rss_kb': rusage.ru_maxrss,
+            'returncode': proc.returncode, 'output': ''.join(output)}
+
+
+def prepare_recollect(workspace):
+    """
+    2回目の collect の前にワークスペースを一部変更する．
+    ブランチ指定のあるリポジトリの半分は別のブランチに切り替え（ブランチの切り替え），
+    指定の無いリポジトリの半分は削除する（既存のミラーからの clone）．
+    """
+    # make_workspace の repo_{i} は i が奇数のものにブランチ指定がある
+    src_dir = os.path.join(workspace['ros_ws'], 'src')
+    for repo in [name for name in os.listdir(src_dir) if name.startswith('repo_')]:
+        checkout = os.path.join(src_dir, repo)
+        index = int(repo.split('_')[1])
+        if index % 4 == 1:
+            with open(os.path.join(checkout, '.git', 'HEAD'), 'w') as f:
+                f.write('ref: refs/heads/bench-local\n')
+        elif index % 4 == 0:
+            shutil.rmtree(checkout)
+
+
+def count_calls(log_path):
+    counts = {}
+    if os.path.exists(log_path):
+        with open(log_path) as f:
+            for line in f:
+                tool = line.split(' ', 1)[0]
+                counts[tool] = counts.get(tool, 0) + 1
+    return counts
+
+
+def benchmark(size, phases, latency, failure_rate, jobs, timeout, keep, robots=1):
+    root = tempfile.mkdtemp(prefix=f"rtsi_bench_{size}_")
+    bin_dir = os.path.join(root, 'bin')
+    install_fake_tools(bin_dir)
+    workspace = make_workspace(root, size, robots)
+    master, nameserver = start_fake_services()
+
+    env = dict(os.environ)
+    env.update({
+        'HOME': workspace['home'], 'ROS_WS': workspace['ros_ws'], 'RTM_WS': workspace['rtm_ws'],
+        'PATH': bin_dir + os.pathsep + env.get('PATH', ''), 'USER': env.get('USER', 'bench'),
+        'ROS_MASTER_URI': f"http://localhost:{master.server_address[1]}",
+        'RTSI_NAMESERVER_PORT': str(nameserver.getsockname()[1]),
+        'RTSI_FAKE_LATENCY': str(latency), 'RTSI_FAKE_FAILURE': str(failure_rate),
+        'RTSI_FAKE_MGR': os.path.join(bin_dir, 'mgr.py'),
+        'LANG': 'C', 'LC_ALL': 'C',
+    })
+    # 常駐コンポーネントとパッケージ検索は失敗させない
+    env['RTSI_FAKE_MGR_PY_FAILURE'] = env['RTSI_FAKE_APT_CACHE_FAILURE'] = '0'
+
+    results = []
+    try:
+        for phase in phases:
+            log_path = os.path.join(root, f"calls_{phase}.log")
+            env['RTSI_FAKE_LOG'] = log_path
+            if phase == 'recollect':
+                prepare_recollect(workspace)
+            result = run_phase(workspace, phase, env, ['--jobs', str(jobs)], timeout)
+            calls = count_calls(log_path)
+            result.update({'size': size, 'phase': phase, 'subprocesses': sum(calls.values()), 'calls': calls})
+            if result['returncode'] not in (0, None):
+                tail = result['output'].strip().splitlines()[-5:]
+                print(f"  {phase}: 終了コード {result['returncode']}\n    " + '\n    '.join(tail))
+            del result['output']
+            results.append(result)
+    finally:
+        master.shutdown()
+        nameserver.close()
+        if keep:
+            print(f"  作業ディレクトリ: {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Systemoperate.py のベンチマーク（偽のツールチェーンを使用）")
+    parser.add_argument('--sizes', default='10,100,1000', help="コンポーネント数（カンマ区切り）")
+    parser.add_argument('--phases', default=','.join(PHASES), help="実行するサブコマンド（カンマ区切り）")
+    parser.add_argument('--latency', type=float, default=0.01, help="偽のコマンドの遅延[s]")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="偽のコマンドが失敗する確率")
+    parser.add_argument('--jobs', type=int, default=4, help="Systemoperate.py に渡す --jobs")
+    parser.add_argument('--timeout', type=float, default=600.0, help="1回の実行のタイムアウト[s]")
+    parser.add_argument('--output', help="結果をJSONで保存するファイル")
+    parser.add_argument('--keep', action='store_true', help="作業ディレクトリを残す")
+    parser.add_argument('--robots', type=int, default=1, help="ロボットの台数（2以上でフリートモード）")
+    options = parser.parse_args()
+
+    phases = [phase for phase in options.phases.split(',') if phase]
+    results = []
+    for size in [int(size) for size in options.sizes.split(',') if size]:
+        print(f"size {size}")
+        results.extend(benchmark(size, phases, options.latency, options.failure_rate,
+                                 options.jobs, options.timeout, options.keep, options.robots))
+
+    print(f"{'size':>6}  {'phase':9}  {'wall[s]':>8}  {'ready[s]':>8}  {'subproc':>7}  {'peakRSS[MB]':>11}  rc")
+    for result in results:
+        ready = f"{result['ready']:8.2f}" if result['ready'] is not None else f"{'-':>8}"
+        print(f"{result['size']:6}  {result['phase']:9}  {result['wall']:8.2f}  {ready}  "
+              f"{result['subprocesses']:7}  {result['peak_rss_kb'] / 1024:11.1f}  {result['returncode']}")
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()